@@ -0,0 +1,357 @@
+import os
+import time
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+import soundfile as sf
+
+import main
+
+# ============================================================
+#  ベンチマーク（合成音源で 解析 / ミックスポイント / Key 推定 / 並び替え / リクエストキュー / 曲名検索 / 再生履歴 を計測）
+#
+#  python benchmark.py                       # 既定サイズで全ステージ
+#  python benchmark.py --sizes 8,32 --tracks 1000,10000,100000 --json out.json
+#
+#  mpv（音声出力）は使わないので、音が出ない Linux 環境でも動く
+# ============================================================
+
+SR = 44100              # 合成音源のサンプリングレート（解析時のリサンプルも計測に含める）
+TRACK_SECONDS = 75.0    # 合成曲の長さ（解析窓 60 秒が曲の中央に収まる長さ）
+BPM_RANGE = (80, 150)
+BPM_TOLERANCE = 0.02    # BPM 正解とみなす誤差（±2%）。倍・半分は別に数える
+
+# ============================================================
+#  合成音源
+# ============================================================
+
+def synth_track(bpm, pitch_class, mode, seconds=TRACK_SECONDS, sr=SR, seed=0):
+    # 既知 BPM のクリック＋既知キーの和音・音階（Krumhansl プロファイルで重み付け）
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sr)
+    t = np.arange(n) / sr
+    y = np.zeros(n, dtype=np.float32)
+
+    profile = main.MAJOR_PROFILE if mode == "major" else main.MINOR_PROFILE
+    weights = np.roll(profile, pitch_class)
+    weights = (weights - weights.min()) / (weights.max() - weights.min())
+    for pc in range(12):
+        if weights[pc] < 0.3:
+            continue
+        f = 261.63 * 2 ** (pc / 12)
+        for octave in (0.5, 1.0, 2.0):
+            y += (0.04 * weights[pc] / octave * np.sin(2 * np.pi * f * octave * t)).astype(np.float32)
+
+    click_len = int(0.03 * sr)
+    env = np.exp(-np.linspace(0, 8, click_len)).astype(np.float32)
+    beat = 60.0 / bpm
+    for k, start in enumerate(np.arange(0, seconds - 0.05, beat)):
+        i = int(start * sr)
+        gain = 0.9 if k % 4 == 0 else 0.6
+        y[i:i + click_len] += gain * env * rng.uniform(-1, 1, click_len).astype(np.float32)
+
+    return y / max(1.0, float(np.abs(y).max()))
+
+def expected_camelot(pitch_class, mode):
+    # 正解の Camelot は解析側の表を使わず五度圏から直接計算する（C major = 08B, A minor = 08A）
+    major_pc = (pitch_class + (3 if mode == "minor" else 0)) % 12
+    number = (7 * major_pc + 7) % 12 + 1
+    return f"{number:02d}{'A' if mode == 'minor' else 'B'}"
+
+def make_library(folder, size, seed=0):
+    # size 曲の WAV と正解（ファイル名 → BPM / Camelot）を作る
+    rng = random.Random(seed)
+    truth = {}
+    for i in range(size):
+        bpm = rng.randint(*BPM_RANGE)
+        pc, mode = rng.randrange(12), rng.choice(["major", "minor"])
+        fn = f"synth_{i:04d}_{bpm}bpm_{main.PITCH_CLASS[pc]}{'m' if mode == 'minor' else ''}.wav"
+        y = synth_track(bpm, pc, mode, seed=seed * 100003 + i)
+        sf.write(os.path.join(folder, fn), np.stack([y, y], axis=1), SR, subtype="PCM_16")
+        truth[fn] = {"bpm": float(bpm), "camelot": expected_camelot(pc, mode)}
+    return truth
+
+def synth_tracks(n, seed=0):
+    # 音声なしの Track だけ（並び替え・検索用）
+    rng = random.Random(seed)
+    return [
+        main.Track(
+            filepath=f"/bench/{i:06d} track {rng.randrange(10 ** 6)}.wav",
+            bpm=rng.uniform(*BPM_RANGE),
+            camelot=rng.choice(main.CAMELOT_CODES),
+            duration=rng.uniform(150, 420),
+        )
+        for i in range(n)
+    ]
+
+# ============================================================
+#  計測
+# ============================================================
+
+def measure(name, fn, items, unit, memory=True):
+    # 1 回目で時間、2 回目で tracemalloc のピークメモリを測る（計測オーバーヘッドを時間に混ぜない）
+    t0 = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - t0
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    row = {
+        "stage": name,
+        "items": items,
+        "seconds": seconds,
+        "throughput": items / seconds if seconds > 0 else float("inf"),
+        "unit": unit,
+        "peak_mb": peak / 2 ** 20 if peak is not None else None,
+    }
+    mem = f"{row['peak_mb']:8.1f}MB" if peak is not None else "       -  "
+    print(f"  {name:<28} {items:>8} {unit:<6} {seconds:9.3f}s {row['throughput']:12.1f}/s {mem}")
+    return row, result
+
+def check_accuracy(results, truth):
+    bpm_ok = bpm_octave = key_ok = low_conf = 0
+    for fn, info in results.items():
+        gt = truth[fn]
+        ratio = info["bpm"] / gt["bpm"] if gt["bpm"] else 0
+        if abs(ratio - 1) <= BPM_TOLERANCE:
+            bpm_ok += 1
+        elif abs(ratio - 2) <= 2 * BPM_TOLERANCE or abs(ratio - 0.5) <= BPM_TOLERANCE / 2:
+            bpm_octave += 1
+        if info["camelot"] == gt["camelot"]:
+            key_ok += 1
+        if (info.get("key_margin") or 0) < main.KEY_CONFIDENCE_MIN:
+            low_conf += 1
+    n = max(1, len(truth))
+    acc = {
+        "bpm_accuracy": bpm_ok / n,
+        "bpm_octave_errors": bpm_octave / n,
+        "key_accuracy": key_ok / n,
+        "key_low_confidence": low_conf / n,
+        "failed": len(truth) - len(results),
+    }
+    print(f"  accuracy: BPM {acc['bpm_accuracy']:.0%} (倍/半分 {acc['bpm_octave_errors']:.0%})"
+          f"  Key {acc['key_accuracy']:.0%} (信頼度低 {acc['key_low_confidence']:.0%})  失敗 {acc['failed']}")
+    return acc
+
+def features_bpm(track):
+    # 特徴量ストアのビート時刻から BPM を出す（保存されていなければ None）
+    features = track.features()
+    if features is None or len(features.beats) < 2:
+        return None
+    return 60.0 / float(np.median(np.diff(features.beats)))
+
+def check_features(tracks, beat_bpms):
+    stored = [(t, b) for t, b in zip(tracks, beat_bpms) if b is not None]
+    ok = sum(abs(b / t.bpm - 1) <= BPM_TOLERANCE for t, b in stored)
+    n = max(1, len(tracks))
+    acc = {"features_stored": len(stored) / n, "features_beat_agreement": ok / n}
+    print(f"  features: 保存 {acc['features_stored']:.0%}  ビート間隔と BPM の一致 {acc['features_beat_agreement']:.0%}")
+    return acc
+
+# ============================================================
+#  ステージ
+# ============================================================
+
+def bench_analysis(size, memory, seed):
+    folder = tempfile.mkdtemp(prefix="numa_bench_")
+    try:
+        truth = make_library(folder, size, seed)
+        files = sorted(truth)
+
+        # 特徴量ストアは一時フォルダに作る（本解析だけが保存する）
+        main.FEATURE_DIR = os.path.join(folder, "features")
+        fps = {fn: main.file_fingerprint(os.path.join(folder, fn), os.path.getsize(os.path.join(folder, fn)))
+               for fn in files}
+
+        def run(tier):
+            out = {}
+            for fn in files:
+                info = main.analyze_single_track(folder, fn, fps[fn], tier=tier)
+                if info:
+                    out[fn] = info
+            return out
+
+        rows = []
+        for name, tier in (("analyze_single_track", main.TIER_FULL), ("analyze_single_track fast", main.TIER_FAST)):
+            row, results = measure(name, lambda: run(tier), size, "tracks", memory)
+            row["audio_seconds_per_second"] = size * TRACK_SECONDS / row["seconds"]
+            row.update(check_accuracy(results, truth))
+            rows.append(row)
+            if tier == main.TIER_FULL:
+                full = results
+
+        # 保存した特徴量を Track.features() の memmap で読み戻し、ビート間隔が解析 BPM と合うか確かめる
+        tracks = [main.make_track(folder, fn, dict(info, fingerprint=fps[fn])) for fn, info in full.items()]
+        row, beat_bpms = measure("Track.features", lambda: [features_bpm(t) for t in tracks],
+                                 len(tracks), "tracks", memory)
+        row.update(check_features(tracks, beat_bpms))
+        rows.append(row)
+
+        # 曲全体のストリーミング解析（ピークメモリは曲の長さに依らず 1 ブロック分）
+        paths = [os.path.join(folder, fn) for fn in files]
+        row, _ = measure("analyze_mix_points", lambda: [main.analyze_mix_points(p) for p in paths],
+                         size, "tracks", memory)
+        row["audio_seconds_per_second"] = size * TRACK_SECONDS / row["seconds"]
+        rows.append(row)
+
+        y, sr, _, _ = main.read_analysis_window(os.path.join(folder, files[0]))
+        chroma_means = np.stack([
+            np.mean(main.load_analysis_stack().feature.chroma_cqt(y=y, sr=sr), axis=1)
+        ] * 1000)
+        key_row, _ = measure("estimate_keys_batch", lambda: main.estimate_keys_batch(chroma_means),
+                             len(chroma_means), "keys", memory)
+        return rows + [key_row]
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+def bench_playlist(n, memory, seed, optimize_budget):
+    tracks = synth_tracks(n, seed)
+    rows = []
+    row, playlist = measure("sort_playlist", lambda: main.sort_playlist(tracks, tracks[0]), n, "tracks", memory)
+    rows.append(row)
+    if optimize_budget > 0:
+        row, (_, report) = measure(
+            "optimize_playlist",
+            lambda: main.optimize_playlist(playlist, time_budget=optimize_budget),
+            n, "tracks", False,
+        )
+        row.update({"greedy_cost": report["greedy_cost"], "optimized_cost": report["optimized_cost"]})
+        rows.append(row)
+    return rows
+
+def bench_queue(n):
+    folder = tempfile.mkdtemp(prefix="numa_bench_q_")
+    try:
+        q = main.RequestQueue(os.path.join(folder, "requests.jsonl"))
+
+        def enqueue():
+            for i in range(n):
+                q.append(f"song_{i}.wav", source="bench")
+
+        def dequeue():
+            got = len(q.read())
+            q.checkpoint()
+            return got
+
+        rows = []
+        row, _ = measure("RequestQueue.append", enqueue, n, "reqs", False)
+        rows.append(row)
+        row, got = measure("RequestQueue.read", dequeue, n, "reqs", False)
+        row["read"] = got
+        rows.append(row)
+        return rows
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+def bench_board(n, seed):
+    # ゲスト n 人が n 曲のライブラリへ 1 回ずつリクエスト → 全部取り出す
+    tracks = synth_tracks(n, seed)
+    rng = random.Random(seed)
+    picks = [rng.choice(tracks) for _ in range(n)]
+    board = main.RequestBoard()
+
+    def admit():
+        for g, t in enumerate(picks):
+            board.admit(t, f"guest{g}", "bench")
+
+    def drain():
+        got = 0
+        while board.pop(tracks[got % n]) is not None:
+            got += 1
+        return got
+
+    rows = []
+    row, _ = measure("RequestBoard.admit", admit, n, "reqs", False)
+    rows.append(row)
+    size = len(board)
+    row, got = measure("RequestBoard.pop", drain, size, "reqs", False)
+    row["popped"] = got
+    rows.append(row)
+    return rows
+
+def bench_history(n, plays, seed):
+    # n 曲のライブラリに plays 件（直近 30 日に散らばる）の再生履歴 → 読み込み・検索・履歴つき並び替え
+    tracks = synth_tracks(n, seed)
+    rng = random.Random(seed)
+    folder = tempfile.mkdtemp(prefix="numa_bench_h_")
+    try:
+        path = os.path.join(folder, "play_history.jsonl")
+        now = time.time()
+        with open(path, "w", encoding="utf-8") as f:
+            for ts in sorted(now - rng.uniform(0, 29 * 86400) for _ in range(plays)):
+                t = rng.choice(tracks)
+                f.write(json.dumps({"ts": ts, "track": t.filename, "fingerprint": t.fingerprint}) + "\n")
+
+        rows = []
+        row, history = measure("PlayHistory load", lambda: main.PlayHistory(path), plays, "plays", False)
+        rows.append(row)
+        row, _ = measure("PlayHistory lookups",
+                         lambda: [(history.last_played(t), history.plays_since(t, 24)) for t in tracks],
+                         n, "tracks", False)
+        rows.append(row)
+        row, _ = measure("build_playlist +history",
+                         lambda: main.build_playlist(tracks, tracks[0], history), n, "tracks", False)
+        rows.append(row)
+        return rows
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+def bench_index(n, memory, seed):
+    tracks = synth_tracks(n, seed)
+    row, index = measure("TrackIndex build", lambda: main.TrackIndex(tracks), n, "tracks", memory)
+    rng = random.Random(seed)
+    queries = [rng.choice(tracks).filename[:12] for _ in range(200)]
+    search_row, _ = measure("TrackIndex.search", lambda: [index.search(q) for q in queries],
+                            len(queries), "query", False)
+    return [row, search_row]
+
+# ============================================================
+#  メイン
+# ============================================================
+
+def parse_sizes(text):
+    return [int(x) for x in text.split(",") if x.strip()]
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="合成音源でのベンチマーク")
+    ap.add_argument("--sizes", default="8,32", help="解析する合成ライブラリの曲数（カンマ区切り）")
+    ap.add_argument("--tracks", default="1000,10000,100000", help="並び替え・検索の曲数（カンマ区切り）")
+    ap.add_argument("--requests", type=int, default=5000, help="リクエストキューの件数")
+    ap.add_argument("--plays", type=int, default=100000, help="再生履歴の件数")
+    ap.add_argument("--optimize", type=float, default=2.0, help="optimize_playlist の秒数（0 で省略）")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--no-memory", action="store_true", help="ピークメモリ計測を省く")
+    ap.add_argument("--skip-analysis", action="store_true", help="音声解析ステージを省く")
+    ap.add_argument("--json", help="結果を JSON で保存するパス")
+    args = ap.parse_args()
+    memory = not args.no_memory
+
+    rows = []
+    if not args.skip_analysis:
+        for size in parse_sizes(args.sizes):
+            print(f"\n🎵 解析: {size} 曲 × {TRACK_SECONDS:.0f}s")
+            rows += bench_analysis(size, memory, args.seed)
+    for n in parse_sizes(args.tracks):
+        print(f"\n📋 並び替え・検索: {n} 曲")
+        rows += bench_playlist(n, memory, args.seed, args.optimize)
+        rows += bench_index(n, memory, args.seed)
+        rows += bench_history(n, args.plays, args.seed)
+    print(f"\n📨 リクエストキュー: {args.requests} 件")
+    rows += bench_queue(args.requests)
+    print(f"\n🗳 リクエスト受付: {args.requests} 人")
+    rows += bench_board(args.requests, args.seed)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 {args.json}")
@@ -1,13 +1,41 @@
 import os
 import time
+
+STARTUP_T0 = time.perf_counter()   # 起動時間の計測起点
+
 import random
+import math
+import asyncio
+import socket
+import argparse
 import datetime
 import json
+import struct
+import zipfile
+import hashlib
+import sqlite3
 import threading
+import contextlib
+import collections
+import bisect
+import heapq
+import itertools
+import unicodedata
+import cProfile
+import http.server
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+try:
+    import fcntl
+except ImportError:   # Windows
+    fcntl = None
 
-import librosa
 import numpy as np
-import mpv
+try:
+    import mpv
+except (ImportError, OSError):   # libmpv が無い環境（解析・ベンチマークのみ）
+    mpv = None
 
 # ============================================================
 #  パス設定
@@ -20,33 +48,174 @@ MUSIC_FOLDER = os.path.join(PUBLIC_DIR, "music")
 DATA_DIR = os.path.join(BASE_DIR, "data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
-ANALYSIS_JSON = os.path.join(DATA_DIR, "analysis_results.json")
-REQUEST_JSON = os.path.join(DATA_DIR, "requests.json")
+ANALYSIS_JSON = os.path.join(DATA_DIR, "analysis_results.json")  # 旧形式（移行用）
+ANALYSIS_DB = os.path.join(DATA_DIR, "analysis_cache.sqlite3")
+REQUEST_JSON = os.path.join(DATA_DIR, "requests.json")  # 旧形式（移行用）
+REQUEST_QUEUE = os.path.join(DATA_DIR, "requests.jsonl")
+PLAY_HISTORY = os.path.join(DATA_DIR, "play_history.jsonl")  # 実際にかかった曲の記録（追記専用）
+ROOM_DIR = os.path.join(DATA_DIR, "rooms")   # 既定ルーム以外のリクエストキュー（<ルーム名>.jsonl）
 
 PLAYLIST_HISTORY_DIR = os.path.join(DATA_DIR, "playlist_history")
 os.makedirs(PLAYLIST_HISTORY_DIR, exist_ok=True)
 
+METRICS_FILE = os.path.join(DATA_DIR, "metrics.prom")
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+RENDER_DIR = os.path.join(DATA_DIR, "renders")
+CONTROL_SOCKET = os.path.join(DATA_DIR, "control.sock")   # コントロールサーバーの Unix ソケット
+FEATURE_DIR = os.path.join(DATA_DIR, "features")   # 曲ごとの特徴量（フィンガープリント名の npz）
+
 # ============================================================
 #  DJ パラメータ（安定版）
 # ============================================================
 
 CROSSFADE_TIME = 3.0    # クロスフェード時間（固定）
-PRELOAD_MARGIN = 3.0    # ★ フェード開始より何秒早く次曲をロードするか（音量0で先読み）
+PRELOAD_MARGIN = 12.0   # ★ フェード開始より何秒早く次曲をロードするか（一時停止のままバッファを満たしておく）
 FADE_STEPS = 60
+PRELOAD_LEAD = CROSSFADE_TIME + PRELOAD_MARGIN + 0.5  # 曲末の何秒前に先読みするか
+DECK_READAHEAD = 30.0   # 次デッキで先に demux しておく秒数（mpv の demuxer-readahead-secs）
+DECK_CACHE_BYTES = "64MiB"      # デッキごとの demuxer キャッシュ上限
+DECK_PREFETCH_BYTES = 8 * 1024 * 1024  # posix_fadvise が無い環境で OS のページキャッシュへ読んでおく量
+SCHEDULE_RESYNC = 0.02  # 再生位置の推定がこれ以上ずれたら予約時刻を付け直す（秒）
 
 BPM_TOLERANCE = 0.10    # プレイリスト並び替え用（再生速度には使わない）
+HARMONIC_BONUS = 50     # 並び替えでハーモニックな遷移を優先するボーナス（BPM 差から引く）
+REPLAN_WINDOW = 8       # リクエスト曲の後ろで並べ直す曲数（2^K 通りの部分集合 DP なので 10 程度まで）
+
+OPTIMIZE_PLAYLIST = False       # True で貪欲法の後に遷移コスト全体を最適化する
+OPTIMIZE_TIME_BUDGET = 2.0      # 最適化に使う秒数
+OPTIMIZE_NEIGHBOURS = 8         # 各曲について調べる遷移先候補数
+OPTIMIZE_TILE_BYTES = 64 * 1024 * 1024  # コスト行列をタイル計算するときの 1 タイルの上限
+OPTIMIZE_DENSE_LIMIT = 4096     # これより多い曲数では密な行列を作らず BPM 近傍の疎な候補だけ使う
+
+# ============================================================
+#  書き出しパラメータ（--render）
+# ============================================================
+
+RENDER_SR = 44100           # 書き出すミックスのサンプリングレート（曲ごとに違えばストリーミングでリサンプル）
+RENDER_BLOCK = 65536        # 1 回に読み書きするフレーム数（メモリ使用量はセットの長さによらずこの程度）
+RENDER_FORMAT = "flac"      # --render にパスを渡さなかった時の拡張子（wav / flac）
+RENDER_SUBTYPE = "PCM_16"
+
+# ============================================================
+#  計測パラメータ
+# ============================================================
+
+METRICS_INTERVAL = 5.0  # metrics.prom を書き出す間隔（秒）
+METRICS_PORT = None     # 例: 9108 にすると http://127.0.0.1:9108/metrics で公開
+PROFILE_STAGES = set()  # cProfile を取るステージ名（例: {"analysis", "playlist_build"}）→ data/profiles/
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# ============================================================
+#  リクエストキュー パラメータ
+# ============================================================
+
+REQUEST_COMPACT_BYTES = 1024 * 1024  # 読み終わったキューがこのサイズを超えたらローテーション
+REQUEST_ROTATE_GRACE = 5.0           # .prev を消すまでに待つ無更新秒数
+
+# ============================================================
+#  コントロールサーバー パラメータ
+# ============================================================
+
+CONTROL_SERVER = True        # Node などから request / skip / status を受け付ける（1 行 1 JSON）
+CONTROL_PORT = 8765          # Unix ソケットが使えない環境（Windows）で 127.0.0.1 に待ち受けるポート
+CONTROL_READ_CHUNK = 64 * 1024   # 1 回に読む量（届いている行はまとめて 1 バッチで処理）
+CONTROL_LINE_LIMIT = 64 * 1024   # 1 行の上限（超えたら切断）
+CONTROL_HIGH_WATER = 256 * 1024  # 送信待ちがこれを超えたクライアントにはイベントを送らない（応答は送る）
+
+# ============================================================
+#  再生履歴パラメータ
+# ============================================================
+
+HISTORY_AVOID_HOURS = 48.0      # これ以内にかかった曲はプレイリストの後ろへ回す（連日のレジデンシーでも前夜・前々夜の曲を繰り返さない）
+HISTORY_TIER_HOURS = (6.0, 30.0)  # その中をさらに段に分ける境目。最近かかった段ほど後ろ（今夜 / 前夜 / それ以前）
+HISTORY_RETENTION_DAYS = 30.0   # 索引に載せる期間。これより古い行は起動時に読み飛ばす
+HISTORY_COMPACT_LINES = 10000   # 読み飛ばした古い行がこれを超えたら、起動時に残す行だけで書き直す
+
+# ============================================================
+#  ルーム（セッション）パラメータ
+# ============================================================
+
+SESSIONS = ["main"]         # 起動時に開くルーム。先頭が既定ルーム（requests.jsonl を読み、room 省略のコマンドを受ける）
+SESSION_MAX = 16            # 同時に開けるルーム数の上限（1 ルームにつき mpv 2 台）
+SESSION_AUDIO_DEVICES = {}  # ルーム名 → mpv の audio-device（例 {"lounge": "pulse/lounge_sink"}）。無ければ既定の出力
+SESSION_NAME_MAX = 32       # ルーム名の最大文字数（英数字・-・_ のみ。キューのファイル名になる）
+
+# ============================================================
+#  リクエスト受付パラメータ
+# ============================================================
+
+REQUEST_BURST = 3              # ゲスト 1 人が続けて出せるリクエスト・投票の数（トークンバケットの容量）
+REQUEST_REFILL = 60.0          # トークンが 1 つ戻るまでの秒数
+REQUEST_VOTE_WEIGHT = 1.0      # 優先度: 1 票の重み
+REQUEST_WAIT_WEIGHT = 1 / 120  # 優先度: 待ち 1 秒の重み（2 分待つと 1 票ぶん）
+REQUEST_HARMONIC_WEIGHT = 1.5  # 優先度: 再生中の曲と Key の相性が良い場合の加点（票換算）
+REQUEST_LIST_LIMIT = 20        # status / queue イベントで返す待ち曲数
+
+# ============================================================
+#  曲名検索パラメータ
+# ============================================================
+
+FUZZY_MIN_SCORE = 0.6    # あいまい一致で採用する最低スコア
+FUZZY_MIN_GAP = 0.15     # 1位と2位のスコア差がこれ未満なら曲を特定しない
+FUZZY_MAX_CANDIDATES = 150   # あいまい検索でスコアを計算する候補数の上限
+FUZZY_MIN_OVERLAP = 2 / 3    # あいまい検索の候補はクエリのトライグラムをこの割合以上含む曲（小さいほど広く探して遅い）
+
+# ============================================================
+#  解析パラメータ
+# ============================================================
+
+ANALYSIS_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # 並列解析プロセス数（1 なら逐次解析）
+CACHE_SAVE_EVERY = 20   # 何曲解析するごとにキャッシュを途中保存するか
+ANALYSIS_SR = 22050     # 解析時のサンプリングレート
+ANALYSIS_WINDOW = 60.0  # 曲の中央から解析する秒数
+KEY_CONFIDENCE_MIN = 0.02  # Key 判定の 1位/2位 相関差がこれ未満なら「信頼度低」
+FINGERPRINT_CHUNK = 64 * 1024  # フィンガープリントで読むチャンクサイズ（先頭・中央・末尾）
+TIER_FAST, TIER_FULL = 1, 2   # 解析の段階（キャッシュの tier 列に記録）
+ANALYSIS_TIERED = True  # 初回は軽い解析で先に再生可能にし、再生中に裏で本解析へ置き換える
+FAST_SR = 11025         # 軽い解析のサンプリングレート
+FAST_WINDOW = 20.0      # 軽い解析で曲の中央から読む秒数
+FEATURE_HOP = 512       # オンセット包絡・クロマのホップ長（ANALYSIS_SR でのサンプル数）
+FEATURE_CHROMA_POOL = 8 # 保存するクロマは何フレームずつ平均して間引くか（512/22050×8 ≒ 0.19 秒）
+MIX_POINTS = True       # 本解析で曲全体をストリーミングし、ミックスイン/アウト位置を求める
+MIX_STREAM_BLOCK = 256  # ストリーミング 1 ブロックのフレーム数（44.1kHz なら約 6 秒分だけをメモリに置く）
+MIX_SILENCE_DB = 40.0   # 曲の基準音量よりこれ以上小さい曲頭は無音とみなして飛ばす
+MIX_TAIL_DB = 12.0      # 曲末でこれ以上小さくなったらフェードアウト・余韻とみなし、その前でミックスアウト
+MIX_SNAP = 2.0          # 出入りの位置を強いオンセット（拍頭）に合わせるために動かしてよい秒数
+MIX_PREROLL = 0.05      # ミックスインをオンセットの少し手前にしてアタックを欠けさせない（秒）
+
+# ============================================================
+#  フォルダ監視パラメータ
+# ============================================================
+
+WATCH_FOLDER = True     # 再生中に music フォルダを監視して曲の追加・変更・削除を反映する
+WATCH_INTERVAL = 2.0    # フォルダを見直す間隔（秒）
+WATCH_SETTLE = 2.0      # 最終更新からこの秒数が経つまではコピー途中とみなして待つ
+WATCH_NICE = 10         # バックグラウンド解析プロセスの nice 値（再生を邪魔しない）
 
 # ============================================================
 #  Track クラス
 # ============================================================
 
 class Track:
-    def __init__(self, filepath, bpm=0.0, camelot="00X", duration=0.0):
+    def __init__(self, filepath, bpm=0.0, camelot="00X", duration=0.0, key_margin=None, fingerprint=None,
+                 mix_in=None, mix_out=None):
         self.filepath = filepath
         self.filename = os.path.basename(filepath)
         self.bpm = bpm
         self.camelot = camelot
         self.duration = duration
+        self.key_margin = key_margin   # Key 判定の信頼度（None は未計測）
+        self.fingerprint = fingerprint # 特徴量ストアの鍵（None は未保存）
+        self.mix_in = mix_in           # 次曲として入る位置（秒）。None は曲頭から
+        self.mix_out = mix_out         # フェードを終える位置（秒）。None は曲末まで
+
+    @property
+    def key_uncertain(self):
+        return self.camelot == "00X" or (self.key_margin is not None and self.key_margin < KEY_CONFIDENCE_MIN)
+
+    def features(self):
+        # 遷移処理で必要になった時だけ特徴量ストアを開く（保存されていなければ None）
+        return load_features(self.fingerprint) if self.fingerprint else None
 
 # ============================================================
 #  Camelot マップ
@@ -68,50 +237,587 @@ CAMELOT_MAP = {
 }
 
 # ============================================================
-#  JSON リクエスト管理
+#  計測（カウンタ・ヒストグラム・ステージ別タイマー → Prometheus テキスト形式）
 # ============================================================
 
-request_lock = threading.Lock()
+def _label_str(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+class Metrics:
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.types = {}        # メトリクス名 → counter / gauge / histogram
+        self.values = {}       # (名前, ラベル) → 値（counter / gauge）
+        self.hists = {}        # (名前, ラベル) → [バケット毎の件数, 合計, 件数]
+
+    def _key(self, name, kind, labels):
+        self.types.setdefault(name, kind)
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            key = self._key(name, "counter", labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[self._key(name, "gauge", labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            key = self._key(name, "histogram", labels)
+            h = self.hists.get(key)
+            if h is None:
+                h = self.hists[key] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage, **labels):
+        # ステージの所要時間を numa_stage_seconds に記録。PROFILE_STAGES に入っていれば cProfile も取る
+        prof = None
+        if stage in PROFILE_STAGES:
+            prof = cProfile.Profile()
+            prof.enable()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("numa_stage_seconds", time.perf_counter() - t0, stage=stage, **labels)
+            if prof is not None:
+                prof.disable()
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                ts = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+                prof.dump_stats(os.path.join(PROFILE_DIR, f"{stage}_{ts}.prof"))
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for name in sorted(self.types):
+                kind = self.types[name]
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "histogram":
+                    for (n, labels), (counts, total, count) in sorted(self.hists.items()):
+                        if n != name:
+                            continue
+                        acc = 0
+                        for le, c in zip(self.buckets, counts):
+                            acc += c
+                            lines.append(f"{name}_bucket{_label_str(labels, [('le', le)])} {acc}")
+                        lines.append(f"{name}_bucket{_label_str(labels, [('le', '+Inf')])} {count}")
+                        lines.append(f"{name}_sum{_label_str(labels)} {total}")
+                        lines.append(f"{name}_count{_label_str(labels)} {count}")
+                else:
+                    for (n, labels), v in sorted(self.values.items()):
+                        if n == name:
+                            lines.append(f"{name}{_label_str(labels)} {v}")
+            return "\n".join(lines) + "\n"
+
+    def write(self, path=METRICS_FILE):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+metrics = Metrics()
+
+def start_metrics_export(path=METRICS_FILE, interval=METRICS_INTERVAL, port=METRICS_PORT):
+    # 一定間隔でファイルに書き出す。port を指定すると http://127.0.0.1:port/metrics でも返す
+    def writer():
+        while True:
+            time.sleep(interval)
+            try:
+                metrics.write(path)
+            except OSError as e:
+                print(f"⚠ メトリクス書き出し失敗: {e}")
+
+    threading.Thread(target=writer, daemon=True).start()
+
+    if port:
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode("utf-8")
+                self.send_response(200 if self.path == "/metrics" else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.end_headers()
+                if self.path == "/metrics":
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"📈 メトリクス: http://127.0.0.1:{port}/metrics")
 
-def load_requests():
+# ============================================================
+#  リクエストキュー（追記専用 JSONL ＋ 読み出し位置カーソル）
+# ============================================================
+#
+#  - 追加: 1 リクエスト = 1 行を O_APPEND で書くだけ（Node 側も同じ形式で追記する）
+#  - 読み出し: 読んだ位置はメモリ上でだけ進める。カーソル（バイト位置）を保存するのは
+#    checkpoint() の時だけ（RequestBoard が「ここまでの行は全部片付いた」と判断した時）
+#    → 落ちて再起動しても、カーソルから先を読み直せば受け付け済み・投票済みのリクエストが戻る
+#  - 書きかけの末尾行（改行なし）は次回まで読まない。壊れた行は読み飛ばす
+#  - 全部片付いてファイルが大きくなったら .prev へローテーション。
+#    ローテーション直前に開かれた書き込みは .prev に届くので、.prev を先に読む
+#  - カーソルには読んでいたファイルの inode を持たせ、再起動時に
+#    「ローテーション後にカーソル保存前で落ちた」「ファイルが作り直された」を判別する
+#
+#  行の種類
+#    {"title", "ts", "guest", "source"}                      受け付け前のリクエスト（Node のオフライン時・CLI）
+#    {"title", "ts", "guest", "source", "admitted", "run"}   RequestBoard が受け付けたリクエスト・投票
+#    {"title", "ts", "played", "run"}                        リクエスト曲をデッキにロードした（消費済み）
+#  run は書いたプロセスの RUN_ID。同じプロセスが書いた受付・消費の行は反映済みなので読み直しても適用しない
+
+RUN_ID = os.urandom(6).hex()
+
+class RequestQueue:
+    def __init__(self, path):
+        self.path = path
+        self.prev_path = path + ".prev"
+        self.cursor_path = path + ".cursor"
+        self.lock = threading.Lock()
+        self.pos = None     # 読んだ位置（カーソルと同じ形。最初の read() で保存済みカーソルから始める）
+
+    def append(self, title, **fields):
+        self.append_many([(title, fields)])
+
+    def append_many(self, items):
+        # [(title, fields)] をまとめて 1 回の write で追記する
+        now = time.time()
+        data = b"".join(
+            (json.dumps({"title": title, "ts": now, **fields}, ensure_ascii=False) + "\n").encode("utf-8")
+            for title, fields in items
+        )
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        for _, fields in items:
+            if not fields.get("played"):
+                metrics.inc("numa_requests_enqueued_total", source=fields.get("source", ""))
+
+    def read(self):
+        # 前回の read() 以降に書かれた行をすべて返す（カーソルは保存しない）
+        t0 = time.perf_counter()
+        with self.lock, self._process_lock():
+            t_locked = time.perf_counter()
+            metrics.observe("numa_request_lock_wait_seconds", t_locked - t0)
+            try:
+                if self.pos is None:
+                    self.pos = self._load_cursor()
+                out = []
+                for path, key, inode in ((self.prev_path, "prev_offset", "prev_inode"),
+                                         (self.path, "offset", "inode")):
+                    while True:
+                        rec, self.pos[key] = self._read_next(path, self.pos[key])
+                        if rec is None:
+                            break
+                        out.append(rec)
+                    if self.pos[inode] is None:
+                        self.pos[inode] = self._inode(path)   # 読み始めた後に作られたファイル
+                metrics.inc("numa_requests_read_total", len(out))
+                return out
+            finally:
+                metrics.observe("numa_request_lock_hold_seconds", time.perf_counter() - t_locked)
+
+    def checkpoint(self):
+        # read() で読んだ行が全部片付いた → カーソルをそこまで進め、大きくなっていればローテーション
+        with self.lock, self._process_lock():
+            if self.pos is None:
+                return
+            self._maybe_rotate(self.pos)
+            self._save_cursor(self.pos)
+
+    @staticmethod
+    def _read_next(path, offset):
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None, offset
+        with f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    return None, offset
+                offset += len(line)
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(rec, str):
+                    rec = {"title": rec}
+                if isinstance(rec, dict) and rec.get("title"):
+                    return rec, offset
+
+    @staticmethod
+    def _inode(path):
+        try:
+            return os.stat(path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _load_cursor(self):
+        try:
+            with open(self.cursor_path, "r", encoding="utf-8") as f:
+                cur = json.load(f)
+        except (FileNotFoundError, ValueError):
+            cur = {}
+        cur = {"offset": cur.get("offset", 0), "inode": cur.get("inode"),
+               "prev_offset": cur.get("prev_offset", 0), "prev_inode": cur.get("prev_inode")}
+
+        ino, prev_ino = self._inode(self.path), self._inode(self.prev_path)
+        if cur["inode"] is not None and cur["inode"] == prev_ino and cur["inode"] != ino:
+            # ローテーション直後に落ちていた
+            cur["prev_offset"], cur["prev_inode"] = cur["offset"], prev_ino
+            cur["offset"] = 0
+        elif cur["inode"] != ino:
+            cur["offset"] = 0
+        if cur["prev_inode"] != prev_ino:
+            cur["prev_offset"] = 0
+        cur["inode"], cur["prev_inode"] = ino, prev_ino
+        return cur
+
+    def _save_cursor(self, cur):
+        tmp = self.cursor_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(cur, f)
+        os.replace(tmp, self.cursor_path)
+
+    def _maybe_rotate(self, cur):
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return
+        if size < REQUEST_COMPACT_BYTES or cur["offset"] < size:
+            return
+        if os.path.exists(self.prev_path):
+            # .prev への遅れた書き込みがもう来ないことを確認してから捨てる
+            if time.time() - os.path.getmtime(self.prev_path) < REQUEST_ROTATE_GRACE:
+                return
+            if cur["prev_offset"] < os.path.getsize(self.prev_path):
+                return
+            os.remove(self.prev_path)
+        os.replace(self.path, self.prev_path)
+        cur["prev_offset"], cur["prev_inode"] = cur["offset"], cur["inode"]
+        cur["offset"], cur["inode"] = 0, None
+
+    @contextlib.contextmanager
+    def _process_lock(self):
+        # 同じキューを読む Python プロセス同士の排他（fcntl が無い環境ではスレッド排他のみ）
+        if fcntl is None:
+            yield
+            return
+        with open(self.cursor_path + ".lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+request_queue = RequestQueue(REQUEST_QUEUE)
+
+def migrate_legacy_requests():
+    # 旧 requests.json に残っているリクエストをキューへ移して空にする
     if not os.path.exists(REQUEST_JSON):
-        return []
+        return
     try:
         with open(REQUEST_JSON, "r", encoding="utf-8") as f:
-            return json.load(f).get("requests", [])
+            lst = json.load(f).get("requests", [])
     except Exception:
-        return []
-
-def save_requests(req_list):
+        return
+    if not lst:
+        return
+    for title in lst:
+        request_queue.append(title, source="legacy")
     with open(REQUEST_JSON, "w", encoding="utf-8") as f:
-        json.dump({"requests": req_list}, f, indent=2, ensure_ascii=False)
+        json.dump({"requests": []}, f, indent=2, ensure_ascii=False)
+    print(f"📦 旧 requests.json から {len(lst)} 件をキューへ移行しました")
 
-def pop_request():
-    with request_lock:
-        lst = load_requests()
+# ============================================================
+#  再生履歴（追記専用 JSONL ＋ 曲ごとの再生時刻リストをメモリに索引）
+# ============================================================
+
+#  1 行 = 1 再生 {"ts": 再生開始の UNIX 時刻, "track": ファイル名, "fingerprint": ..., "room": ...}
+#  - 予定（プレイリスト）ではなく、デッキが入れ替わって実際に鳴り始めた曲を記録する
+#  - 曲の鍵はフィンガープリント（無ければファイル名）。ファイル名を変えても履歴は引き継がれる
+#  - 最終再生は dict 1 回、直近 N 時間の回数はその曲の再生時刻リストの二分探索（履歴全体の量に依らない）
+
+class PlayHistory:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.plays = {}   # 曲の鍵 → 再生時刻（昇順）
+        self.load()
+
+    @staticmethod
+    def key(track):
+        return track.fingerprint or track.filename
+
+    def load(self):
+        t0 = time.perf_counter()
+        cutoff = time.time() - HISTORY_RETENTION_DAYS * 86400
+        kept, stale, raw = [], 0, None
+        try:
+            with open(self.path, "rb") as f:
+                for raw in f:
+                    try:
+                        rec = json.loads(raw)
+                        ts, key = float(rec["ts"]), rec.get("fingerprint") or rec["track"]
+                    except (ValueError, KeyError, TypeError):
+                        stale += 1   # 書き込み途中で落ちた行など
+                        continue
+                    if ts < cutoff:
+                        stale += 1
+                        continue
+                    kept.append(raw if raw.endswith(b"\n") else raw + b"\n")
+                    self._index(key, ts)
+                torn = raw is not None and not raw.endswith(b"\n")
+        except FileNotFoundError:
+            return
+        if torn:
+            # 書き込み途中で落ちた最終行の後ろに次の記録がつながらないよう改行で閉じる
+            with open(self.path, "ab") as f:
+                f.write(b"\n")
+        if stale > HISTORY_COMPACT_LINES:
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.writelines(kept)
+            os.replace(tmp, self.path)
+            print(f"🗜 再生履歴を整理しました（古い {stale} 件を削除）")
+        metrics.observe("numa_stage_seconds", time.perf_counter() - t0, stage="history_load")
+        metrics.set("numa_history_plays", len(kept))
+
+    def _index(self, key, ts):
+        lst = self.plays.setdefault(key, [])
+        if lst and ts < lst[-1]:
+            bisect.insort(lst, ts)   # 時計が戻った場合だけ
+        else:
+            lst.append(ts)
+
+    def record(self, track, room=None, ts=None):
+        ts = time.time() if ts is None else ts
+        rec = {"ts": ts, "track": track.filename, "fingerprint": track.fingerprint}
+        if room:
+            rec["room"] = room
+        line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+            self._index(self.key(track), ts)
+        metrics.inc("numa_history_plays_total", **({"room": room} if room else {}))
+
+    def last_played(self, track):
+        # 最後に鳴り始めた UNIX 時刻（記録が無ければ None）
+        lst = self.plays.get(self.key(track))
+        return lst[-1] if lst else None
+
+    def plays_since(self, track, hours):
+        lst = self.plays.get(self.key(track))
         if not lst:
-            return None
-        v = lst.pop(0)
-        save_requests(lst)
-        return v
+            return 0
+        return len(lst) - bisect.bisect_left(lst, time.time() - hours * 3600)
+
+    def partition(self, tracks, hours=HISTORY_AVOID_HOURS, tiers=HISTORY_TIER_HOURS):
+        # 最後にかかってからの時間で段に分ける: [hours 以内にかかっていない曲, 古くかかった段, …, 直近の段]
+        # 段の境目は tiers と hours（時間）。各段の中は元の順序のまま
+        bounds = sorted({*(h for h in tiers if h < hours), hours})
+        groups = [[] for _ in range(len(bounds) + 1)]
+        now = time.time()
+        for t in tracks:
+            lst = self.plays.get(self.key(t))
+            age = (now - lst[-1]) / 3600 if lst else hours
+            groups[len(bounds) - bisect.bisect_right(bounds, age)].append(t)
+        return groups
 
-def add_request_to_json(filename):
-    with request_lock:
-        lst = load_requests()
-        lst.append(filename)
-        save_requests(lst)
+# ============================================================
+#  曲名インデックス（完全一致は dict、部分・あいまい一致は前方一致＋トライグラム）
+# ============================================================
+
+def normalize_title(name):
+    # 全角/半角・大文字小文字・拡張子・区切り記号の違いを吸収した検索用キー
+    base, ext = os.path.splitext(name)
+    if ext.lower() in (".wav", ".mp3", ".flac"):
+        name = base
+    name = unicodedata.normalize("NFKC", name).casefold()
+    return " ".join(name.replace("_", " ").replace("-", " ").split())
+
+def trigrams(s):
+    s = f"  {s} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+class TrackIndex:
+    def __init__(self, tracks=()):
+        self.by_name = {}        # ファイル名 → Track（完全一致）
+        self.by_norm = {}        # 正規化名 → [Track]
+        self.sorted_norms = []   # 前方一致用に正規化名をソート
+        self.grams = {}          # トライグラム → {正規化名}
+        self.norm_grams = {}     # 正規化名 → そのトライグラム集合
+        self.norm_id = {}        # 正規化名 → 通し番号（登録順。削除した番号は再利用しない）
+        self.id_norm = []        # 通し番号 → 正規化名（削除済みは None）
+        self.gram_ids = {}       # トライグラム → 含む曲の通し番号の int32 配列（追加・削除で捨て、次の検索時に作り直す）
+        self.lock = threading.RLock()   # フォルダ監視スレッドからの追加・削除と検索の排他
+        for t in tracks:
+            self.add(t, bulk=True)
+        self.sorted_norms = sorted(self.by_norm)
+        # 一括登録中に溜めた番号リストを配列にする（番号は登録順なので並んでいる）
+        # 同名ファイルの入れ替えで途中から溜め直したものは欠けているので、検索時に作り直させる
+        self.gram_ids = {gram: np.array(ids, dtype=np.int32) for gram, ids in self.gram_ids.items()
+                         if len(ids) == len(self.grams[gram])}
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.by_name.values())
+
+    def add(self, track, bulk=False):
+        with self.lock:
+            if track.filename in self.by_name:
+                self.remove(track.filename)
+            self.by_name[track.filename] = track
+            norm = normalize_title(track.filename)
+            bucket = self.by_norm.setdefault(norm, [])
+            bucket.append(track)
+            if len(bucket) == 1:
+                if not bulk:
+                    bisect.insort(self.sorted_norms, norm)
+                g = trigrams(norm)
+                self.norm_grams[norm] = g
+                i = self.norm_id[norm] = len(self.id_norm)
+                self.id_norm.append(norm)
+                for gram in g:
+                    self.grams.setdefault(gram, set()).add(norm)
+                    if bulk:
+                        self.gram_ids.setdefault(gram, []).append(i)
+                    else:
+                        self.gram_ids.pop(gram, None)
+
+    def remove(self, filename):
+        with self.lock:
+            track = self.by_name.pop(filename, None)
+            if track is None:
+                return None
+            norm = normalize_title(filename)
+            bucket = self.by_norm[norm]
+            bucket.remove(track)
+            if not bucket:
+                del self.by_norm[norm]
+                i = bisect.bisect_left(self.sorted_norms, norm)
+                if i < len(self.sorted_norms) and self.sorted_norms[i] == norm:   # 一括登録中はまだ並べていない
+                    del self.sorted_norms[i]
+                for gram in self.norm_grams.pop(norm):
+                    self.grams[gram].discard(norm)
+                    self.gram_ids.pop(gram, None)
+                self.id_norm[self.norm_id.pop(norm)] = None
+            return track
+
+    def get(self, name):
+        # 完全一致 → 正規化後の一致（1曲に決まる場合のみ）
+        with self.lock:
+            t = self.by_name.get(name)
+            if t is not None:
+                return t
+            bucket = self.by_norm.get(normalize_title(name))
+            return bucket[0] if bucket and len(bucket) == 1 else None
+
+    def search(self, query, limit=5):
+        # (スコア, Track) をスコア順に返す。前方一致 > 部分一致 > トライグラム類似度
+        q = normalize_title(query)
+        if not q:
+            return []
+        with self.lock:
+            scores = {}
+
+            i = bisect.bisect_left(self.sorted_norms, q)
+            while i < len(self.sorted_norms) and self.sorted_norms[i].startswith(q) and len(scores) < limit:
+                scores[self.sorted_norms[i]] = 2.0 + len(q) / len(self.sorted_norms[i])
+                i += 1
+            if len(scores) >= limit:
+                # トライグラム側のスコアは 2.0 以下なので前方一致だけで埋まれば順位は変わらない
+                return [(score, t) for norm, score in sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))
+                        for t in self.by_norm[norm]][:limit]
+
+            # クエリのトライグラムを m 個（FUZZY_MIN_OVERLAP の割合）以上含む曲は、出現数の少ない方から
+            # (|qg| - m + 1) 個のトライグラムのどれかを必ず含む → そこだけから候補を集める
+            # 何個含むかを通し番号の配列で数え（Python のループを回さない）、多い順に上限まで採る
+            # 同数の曲は初めて出てきた順（珍しいトライグラムの順 → 通し番号順）なので集合の反復順に依らない
+            qg = trigrams(q)
+            rare = sorted((g for g in qg if g in self.grams), key=lambda g: (len(self.grams[g]), g))
+            need = len(qg) - math.ceil(len(qg) * FUZZY_MIN_OVERLAP) + 1
+            overlap = np.zeros(len(self.id_norm), dtype=np.uint16)
+            seen = [np.empty(0, dtype=np.int32)]
+            for g in rare[:need]:
+                ids = self._gram_ids(g)
+                seen.append(ids[overlap[ids] == 0])
+                overlap[ids] += 1
+            hit = np.concatenate(seen)
+            counts = overlap[hit]
+            # 上から累積して上限に届く個数 cut を求め、cut より多い曲は全部、cut ちょうどの曲は登録順に残りを採る
+            above = np.cumsum(np.bincount(counts)[::-1])[::-1]
+            cut = max(1, int(np.searchsorted(-above, -FUZZY_MAX_CANDIDATES, side="right")) - 1)
+            ids = hit[counts > cut]
+            ties = hit[counts == cut][:FUZZY_MAX_CANDIDATES - len(ids)]
+            cands = [self.id_norm[i] for i in np.concatenate([ids, ties]).tolist()]
+            for norm in cands:
+                if norm in scores:
+                    continue
+                ng = self.norm_grams[norm]
+                dice = 2 * len(qg & ng) / (len(qg) + len(ng))
+                if q in norm:
+                    dice += 1.0
+                scores[norm] = dice
+
+            ranked = heapq.nsmallest(limit, scores.items(), key=lambda kv: (-kv[1], kv[0]))
+            return [(score, t) for norm, score in ranked for t in self.by_norm[norm]][:limit]
+
+    def _gram_ids(self, gram):
+        ids = self.gram_ids.get(gram)
+        if ids is None:
+            p = self.grams[gram]
+            ids = np.fromiter((self.norm_id[n] for n in p), dtype=np.int32, count=len(p))
+            ids.sort()
+            self.gram_ids[gram] = ids
+        return ids
+
+    def resolve(self, name):
+        # リクエスト文字列を 1 曲に決める（あいまい一致は 1 位が十分に高く、2 位と差がある場合のみ）
+        t = self.get(name)
+        if t is not None:
+            return t
+        hits = self.search(name, limit=2)
+        if not hits or hits[0][0] < FUZZY_MIN_SCORE:
+            return None
+        if len(hits) > 1 and hits[0][0] - hits[1][0] < FUZZY_MIN_GAP:
+            return None
+        return hits[0][1]
 
 # ============================================================
 #  CLI リクエスト受付
 # ============================================================
 
-def cli_request_loop(tracks):
+def cli_request_loop(index, engine=None):
     print("\n💡 曲名を入力すると次曲としてリクエストされます")
-    print("   例: songA.wav（public/music に存在する必要あり）")
+    print("   例: songA.wav（public/music に存在する必要あり・曲名の一部でも可）")
+    if engine is not None and len(engine.rooms()) > 1:
+        print("   既定以外のルームへは「@ルーム名 曲名」")
     print("   Ctrl+C で CLI 入力のみ終了します\n")
 
-    names = [t.filename for t in tracks]
-
     while True:
         try:
             name = input("🎧 リクエスト曲ファイル名 > ").strip()
@@ -122,39 +828,231 @@ def cli_request_loop(tracks):
         if not name:
             continue
 
-        if name not in names:
-            print("⚠ その曲は解析済みリストに存在しません")
+        queue = request_queue
+        if name.startswith("@") and engine is not None:
+            room, _, name = name[1:].partition(" ")
+            session = engine.get(room)
+            if session is None:
+                print(f"⚠ ルーム {room} はありません")
+                continue
+            queue, name = session.scheduler.queue, name.strip()
+
+        track = index.resolve(name)
+        if track is None:
+            hits = index.search(name)
+            if not hits:
+                print("⚠ その曲は解析済みリストに存在しません")
+            else:
+                print("⚠ 曲を特定できません。候補:")
+                for _, t in hits:
+                    print(f"   - {t.filename}")
             continue
 
-        add_request_to_json(name)
-        print(f"✅ リクエスト追加: {name}")
+        queue.append(track.filename, source="cli")
+        print(f"✅ リクエスト追加: {track.filename}")
 
 # ============================================================
-#  Key 推定
+#  リクエスト受付（重複は投票にまとめ、ゲストごとにトークンバケット、優先度順に出す）
 # ============================================================
 
-def estimate_key(y, sr):
-    chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
-    chroma_mean = np.mean(chroma, axis=1)
+#  優先度 = 票数 × REQUEST_VOTE_WEIGHT + 待ち秒数 × REQUEST_WAIT_WEIGHT (+ 相性が良ければ REQUEST_HARMONIC_WEIGHT)
+#  - 待ち時間の項は全曲に同じ速さで加わるので、「票数 × 重み - 受付時刻 × 重み」だけでヒープ順が決まる
+#  - Key の相性は再生中の曲で変わるため、Camelot ごと（24 + 不明）に別ヒープを持ち、
+#    取り出し時に各ヒープの先頭だけに加点して比べる → 取り出しは O(25 log n)
+#  - 投票で優先度が上がった曲は新しい版をヒープに積み、古い版は先頭に来た時に捨てる
+#  - journal（RequestQueue）を渡すと、受け付け・投票・消費をすべて追記してから反映する。
+#    追記はボードのロック内で行うので、ファイルの行の順序がそのままボードの変化の順序になり、
+#    再起動時は保存済みカーソルから読み直す（drain）だけで待ち行列と票が元に戻る
+#  - 受付時刻はリクエスト行の ts（壁時計）。読み直した時も待ち時間・トークンの回復が元どおりになる
+
+class RequestBoard:
+    def __init__(self, journal=None):
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.t0 = time.time()
+        self.entries = {}    # ファイル名 → {"track", "votes", "since", "voters", "version"}
+        self.heaps = {}      # Camelot 番号 → [(-基本優先度, 順序, ファイル名, 版)]
+        self.buckets = {}    # ゲスト → [トークン数, 最終更新時刻]
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def admit(self, track, guest=None, source="", ts=None, limit=True, record=True):
+        # 戻り値: "queued" / "voted" / "already_voted" / "rate_limited"
+        # guest が None（CLI・旧形式の移行分）は回数制限しない
+        # ジャーナルから読んだ行は record=False（既に書かれている）。受付済みの行は limit=False
+        with self.lock:
+            now = time.time() if ts is None else ts
+            entry = self.entries.get(track.filename)
+            if entry is not None and guest is not None and guest in entry["voters"]:
+                result = "already_voted"
+            elif guest is not None and limit and not self._take_token(guest, now):
+                result = "rate_limited"
+            else:
+                if self.journal is not None and record:
+                    self.journal.append(track.filename, ts=now, guest=guest, source=source,
+                                        admitted=True, run=RUN_ID)
+                result = self._apply(track, guest, now, entry)
+            metrics.inc("numa_requests_admitted_total", result=result, source=source)
+            metrics.set("numa_request_board_size", len(self.entries))
+            entry = self.entries.get(track.filename)
+            return result, (entry["votes"] if entry else 0)
+
+    def _apply(self, track, guest, now, entry):
+        if entry is None:
+            entry = {"track": track, "votes": 1, "since": now - self.t0,
+                     "voters": {guest} if guest is not None else set(), "version": None}
+            self.entries[track.filename] = entry
+            self._push(entry)
+            return "queued"
+        entry["votes"] += 1
+        if guest is not None:
+            entry["voters"].add(guest)
+        self._push(entry)
+        return "voted"
+
+    def _take_token(self, guest, now):
+        # ts は別プロセス（Node）の時計のこともあるので、時刻が戻った分は回復させない
+        tokens, last = self.buckets.get(guest, (REQUEST_BURST, now))
+        now = max(now, last)
+        tokens = min(REQUEST_BURST, tokens + (now - last) / REQUEST_REFILL)
+        if tokens < 1:
+            self.buckets[guest] = (tokens, now)
+            return False
+        self.buckets[guest] = (tokens - 1, now)
+        return True
 
-    major_profile = np.array([6.35,2.23,3.48,2.33,4.38,4.09,2.52,5.19,2.39,3.66,2.29,2.88])
-    minor_profile = np.array([6.33,2.68,3.52,5.38,2.60,3.53,2.54,4.75,3.98,2.69,3.34,3.17])
+    @staticmethod
+    def _base(entry):
+        return entry["votes"] * REQUEST_VOTE_WEIGHT - entry["since"] * REQUEST_WAIT_WEIGHT
+
+    def _push(self, entry):
+        # 版はボード全体の通し番号。取り出し後に同じ曲が再リクエストされても古い要素とは一致しない
+        version = entry["version"] = next(self.seq)
+        heap = self.heaps.setdefault(camelot_code(entry["track"].camelot), [])
+        heapq.heappush(heap, (-self._base(entry), version, entry["track"].filename, version))
+
+    def _top(self, heap):
+        # 古い版・取り出し済みを捨てて先頭を返す
+        while heap:
+            _, _, fn, version = heap[0]
+            entry = self.entries.get(fn)
+            if entry is not None and entry["version"] == version:
+                return heap[0]
+            heapq.heappop(heap)
+        return None
 
-    pitch_class = ['C','C#','D','Eb','E','F','F#','G','Ab','A','Bb','B']
+    def pop(self, current=None, load=None):
+        # 再生中の曲 current との相性込みで最も優先度の高いリクエストを取り出す
+        # load(track) を渡すとロックを持ったままデッキへ載せ、成功してから消費済みをジャーナルへ書く
+        # （その間に来た同じ曲の再リクエストは、ジャーナル上も消費の後の新しいリクエストになる）
+        with self.lock:
+            cc = camelot_code(current.camelot) if current is not None else -1
+            best, best_key = None, None
+            for code, heap in self.heaps.items():
+                top = self._top(heap)
+                if top is None:
+                    continue
+                score = -top[0]
+                if cc >= 0 and code >= 0 and HARMONIC_TABLE[cc][code]:
+                    score += REQUEST_HARMONIC_WEIGHT
+                key = (-score, top[1])
+                if best_key is None or key < best_key:
+                    best, best_key = heap, key
+            if best is None:
+                return None
+            _, _, fn, _ = heapq.heappop(best)
+            entry = self.entries.pop(fn)
+            if load is not None:
+                load(entry["track"])
+            if self.journal is not None:
+                self.journal.append(fn, played=True, run=RUN_ID)
+            metrics.observe("numa_request_wait_seconds", time.time() - self.t0 - entry["since"])
+            metrics.set("numa_request_board_size", len(self.entries))
+            return entry["track"]
+
+    def remove(self, filename):
+        with self.lock:
+            self.entries.pop(filename, None)
+
+    def pending(self, limit=REQUEST_LIST_LIMIT):
+        # 表示用: 相性を除いた優先度順に [{"track", "votes"}]
+        with self.lock:
+            top = heapq.nsmallest(limit, self.entries.values(), key=lambda e: -self._base(e))
+            return [{"track": e["track"].filename, "votes": e["votes"]} for e in top]
+
+    def drain(self, index):
+        # ジャーナルの新しい行を読んで反映する。起動直後は保存済みカーソルからの読み直し（前回の待ち行列の復元）
+        # 待ちが空になったらそこまでの行は全部片付いているので、カーソルを進める
+        if self.journal is None:
+            return 0
+        n = 0
+        for rec in self.journal.read():
+            if rec.get("run") == RUN_ID:
+                continue   # このプロセスが書いた受付・消費（反映済み）
+            title = rec.get("title", "")
+            if rec.get("played"):
+                self.remove(title)
+                continue
+            track = index.resolve(title)
+            if track is None:
+                print(f"⚠ リクエスト不明（スキップ）: {title}")
+                continue
+            ts = rec.get("ts")
+            self.admit(track, rec.get("guest"), rec.get("source", ""),
+                       ts=ts if isinstance(ts, (int, float)) else None,
+                       limit=not rec.get("admitted"), record=False)
+            n += 1
+        with self.lock:
+            if not self.entries:
+                self.journal.checkpoint()
+        return n
 
-    max_score = -1
-    best_key = 0
-    best_mode = 'major'
+# ============================================================
+#  Key 推定
+# ============================================================
+
+PITCH_CLASS = ['C','C#','D','Eb','E','F','F#','G','Ab','A','Bb','B']
+
+MAJOR_PROFILE = np.array([6.35,2.23,3.48,2.33,4.38,4.09,2.52,5.19,2.39,3.66,2.29,2.88])
+MINOR_PROFILE = np.array([6.33,2.68,3.52,5.38,2.60,3.53,2.54,4.75,3.98,2.69,3.34,3.17])
 
+def _build_key_templates():
+    # 24 キー分の回転プロファイルを「平均0・ノルム1」にしておく
+    # → 相関係数はクロマ側も正規化すれば内積 1 回で全キー分求まる
+    rows, labels = [], []
     for i in range(12):
-        s1 = np.corrcoef(chroma_mean, np.roll(major_profile, i))[0,1]
-        s2 = np.corrcoef(chroma_mean, np.roll(minor_profile, i))[0,1]
-        if s1 > max_score:
-            max_score, best_key, best_mode = s1, i, 'major'
-        if s2 > max_score:
-            max_score, best_key, best_mode = s2, i, 'minor'
+        rows.append(np.roll(MAJOR_PROFILE, i)); labels.append((PITCH_CLASS[i], 'major'))
+        rows.append(np.roll(MINOR_PROFILE, i)); labels.append((PITCH_CLASS[i], 'minor'))
+    m = np.array(rows)
+    m -= m.mean(axis=1, keepdims=True)
+    m /= np.linalg.norm(m, axis=1, keepdims=True)
+    return m, labels
+
+KEY_TEMPLATES, KEY_LABELS = _build_key_templates()   # (24, 12)
+
+def estimate_keys_batch(chroma_means):
+    # chroma_means: (12,) または (N, 12)。各曲の (key, mode, margin) を返す
+    # margin = 1位と2位の相関の差（小さいほど判定が怪しい）
+    x = np.atleast_2d(np.asarray(chroma_means, dtype=np.float64))
+    x = x - x.mean(axis=1, keepdims=True)
+    norm = np.linalg.norm(x, axis=1, keepdims=True)
+    x = np.divide(x, norm, out=np.zeros_like(x), where=norm > 0)
+
+    scores = x @ KEY_TEMPLATES.T                     # (N, 24)
+    best = np.argmax(scores, axis=1)
+    top2 = np.partition(scores, -2, axis=1)[:, -2:]
+    margins = top2[:, 1] - top2[:, 0]
+
+    return [(*KEY_LABELS[b], float(m)) for b, m in zip(best, margins)]
+
+ENHARMONIC = {"C#": "Db", "Db": "C#", "D#": "Eb", "Eb": "D#", "F#": "Gb", "Gb": "F#",
+              "G#": "Ab", "Ab": "G#", "A#": "Bb", "Bb": "A#"}
 
-    return pitch_class[best_key], best_mode
+def key_to_camelot(key, mode):
+    # CAMELOT_MAP はキーごとに片方の表記しか持たないので、異名同音でも引く
+    return CAMELOT_MAP.get((key, mode)) or CAMELOT_MAP.get((ENHARMONIC.get(key, key), mode), "00X")
 
 def get_camelot_number(code):
     if code == "00X":
@@ -173,229 +1071,2049 @@ def is_harmonic(a, b):
     diff = abs(na - nb)
     return la == lb and (diff == 1 or diff == 11)
 
+# Camelot を 0..23 の整数に（"01A"=0, "01B"=1, ... "12B"=23、不明は -1）
+CAMELOT_CODES = [f"{n:02d}{l}" for n in range(1, 13) for l in "AB"]
+CAMELOT_INDEX = {c: i for i, c in enumerate(CAMELOT_CODES)}
+
+def camelot_code(camelot):
+    return CAMELOT_INDEX.get(camelot, -1)
+
+# 24×24 のハーモニック相性表と、各 Key の相性 Key リスト
+HARMONIC_TABLE = [[is_harmonic(a, b) for b in CAMELOT_CODES] for a in CAMELOT_CODES]
+HARMONIC_NEIGHBOURS = [[j for j, ok in enumerate(row) if ok] for row in HARMONIC_TABLE]
+
+# ============================================================
+#  解析ライブラリの遅延読み込み
+# ============================================================
+
+# librosa は numba / llvmlite / scipy / sklearn を連れてきて起動が数秒遅くなるので、
+# 未解析曲が見つかって実際に解析する時に初めて読み込む（キャッシュだけで起動する場合は読まない）
+librosa = None
+sf = None
+
+def load_analysis_stack():
+    global librosa, sf
+    if librosa is None:
+        t0 = time.perf_counter()
+        import librosa as _librosa
+        import soundfile as _sf
+        librosa, sf = _librosa, _sf
+        metrics.observe("numa_stage_seconds", time.perf_counter() - t0, stage="import_librosa")
+        print(f"📚 解析ライブラリ読み込み ({time.perf_counter() - t0:.1f}s)")
+    return librosa
+
+# ============================================================
+#  解析用オーディオ読み込み（中央区間だけを 1 回でデコード）
+# ============================================================
+
+# (フォーマットタグ, ビット数) -> (dtype, スケール, オフセット)  ※ memmap で直接読める PCM/float
+WAV_MEMMAP_DTYPES = {
+    (1, 8):  ("u1", 1 / 128, 128.0),
+    (1, 16): ("<i2", 1 / 32768, 0.0),
+    (1, 32): ("<i4", 1 / 2147483648, 0.0),
+    (3, 32): ("<f4", 1.0, 0.0),
+    (3, 64): ("<f8", 1.0, 0.0),
+}
+
+def read_wav_header(path):
+    # RIFF チャンクを辿って fmt / data の位置だけ読む（サンプルは読まない）
+    with open(path, "rb") as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            return None
+        file_size = os.fstat(f.fileno()).st_size
+        fmt = None
+        while True:
+            hdr = f.read(8)
+            if len(hdr) < 8:
+                return None
+            cid, size = hdr[:4], struct.unpack("<I", hdr[4:])[0]
+            if cid == b"fmt ":
+                body = f.read(size)
+                tag, channels, rate, _, block_align, bits = struct.unpack("<HHIIHH", body[:16])
+                if tag == 0xFFFE and size >= 26:   # WAVE_FORMAT_EXTENSIBLE
+                    tag = struct.unpack("<H", body[24:26])[0]
+                fmt = (tag, channels, rate, block_align, bits)
+                if size % 2:
+                    f.seek(1, 1)
+            elif cid == b"data":
+                if fmt is None or fmt[3] == 0:
+                    return None
+                tag, channels, rate, block_align, bits = fmt
+                offset = f.tell()
+                size = min(size, file_size - offset)   # 0xFFFFFFFF などの壊れたサイズ対策
+                return {
+                    "format": tag, "channels": channels, "samplerate": rate,
+                    "block_align": block_align, "bits": bits,
+                    "data_offset": offset, "frames": size // block_align,
+                }
+            else:
+                f.seek(size + (size % 2), 1)
+
+def read_analysis_window(path, sr=ANALYSIS_SR, window=ANALYSIS_WINDOW):
+    # 曲長はヘッダから取得し、中央 window 秒だけを読み込む。(y, sr, 曲長, 切り出し開始秒) を返す
+    # PCM WAV は memmap でその区間だけ参照、それ以外は soundfile でシークして読む
+    load_analysis_stack()
+    hdr = read_wav_header(path)
+    spec = WAV_MEMMAP_DTYPES.get((hdr["format"], hdr["bits"])) if hdr else None
+
+    if spec and hdr["block_align"] == hdr["channels"] * np.dtype(spec[0]).itemsize:
+        native_sr, frames = hdr["samplerate"], hdr["frames"]
+    else:
+        hdr, spec = None, None
+        info = sf.info(path)
+        native_sr, frames = info.samplerate, info.frames
+
+    duration = frames / native_sr
+    start = int(max(0.0, (duration - window) / 2) * native_sr)
+    stop = min(frames, start + int(window * native_sr))
+
+    if spec:
+        dtype, scale, bias = spec
+        mm = np.memmap(path, dtype=dtype, mode="r", offset=hdr["data_offset"],
+                       shape=(frames, hdr["channels"]))
+        y = mm[start:stop].mean(axis=1, dtype=np.float32)
+        del mm
+        if bias:
+            y -= bias
+        if scale != 1.0:
+            y *= scale
+    else:
+        with sf.SoundFile(path) as f:
+            f.seek(start)
+            y = f.read(stop - start, dtype="float32", always_2d=True).mean(axis=1)
+
+    # リサンプルは切り出した区間に対して 1 回だけ
+    if native_sr != sr:
+        y = librosa.resample(y, orig_sr=native_sr, target_sr=sr)
+    return np.ascontiguousarray(y, dtype=np.float32), sr, duration, start / native_sr
+
 # ============================================================
 #  楽曲解析
 # ============================================================
 
-def analyze_single_track(folder, filename):
+def analyze_single_track(folder, filename, fingerprint=None, tier=TIER_FULL):
+    # fingerprint を渡すとビート・オンセット包絡・クロマを特徴量ストアにも保存する（本解析のみ）
+    # tier=TIER_FAST は低いサンプリングレート・短い区間で BPM / Key だけを素早く出す
     path = os.path.join(folder, filename)
+    t0 = time.perf_counter()
     try:
-        duration = librosa.get_duration(path=path)
-        offset = max(0, (duration - 60) / 2)
-        y, sr = librosa.load(path, sr=22050, offset=offset, duration=60)
-
-        tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+        if tier == TIER_FAST:
+            y, sr, duration, offset = read_analysis_window(path, FAST_SR, FAST_WINDOW)
+        else:
+            y, sr, duration, offset = read_analysis_window(path)
+
+        # オンセット包絡は beat_track 内部でも同じものを作るので 1 回だけ計算して渡す
+        # ホップはサンプリングレートに比例させ、簡易解析でもフレーム間隔（テンポ分解能）を保つ
+        hop = FEATURE_HOP * sr // ANALYSIS_SR
+        onset = librosa.onset.onset_strength(y=y, sr=sr, hop_length=hop, aggregate=np.median)
+        tempo, beats = librosa.beat.beat_track(onset_envelope=onset, sr=sr, hop_length=hop)
         bpm = float(tempo[0] if isinstance(tempo, np.ndarray) else tempo)
 
-        key, mode = estimate_key(y, sr)
-        if key == "C#": key = "Db"
-        if key == "D#": key = "Eb"
-        camelot = CAMELOT_MAP.get((key, mode), "00X")
+        chroma = librosa.feature.chroma_cqt(y=y, sr=sr, hop_length=hop)
+        key, mode, key_margin = estimate_keys_batch(np.mean(chroma, axis=1))[0]
+        camelot = key_to_camelot(key, mode)
+
+        if fingerprint and tier == TIER_FULL:
+            save_features(fingerprint, offset, sr,
+                          beats=librosa.frames_to_time(beats, sr=sr, hop_length=hop),
+                          onset=onset, chroma=chroma)
 
-        print(f"解析OK: {filename} BPM:{bpm:.1f} Key:{camelot}")
-        return {"bpm": bpm, "camelot": camelot, "duration": duration}
+        info = {"bpm": bpm, "camelot": camelot, "duration": duration, "key_margin": key_margin, "tier": tier}
+        if MIX_POINTS and tier == TIER_FULL:
+            info["mix_in"], info["mix_out"] = analyze_mix_points(path)
+
+        note = " ⚠Key信頼度低" if key_margin < KEY_CONFIDENCE_MIN else ""
+        note += " (簡易)" if tier == TIER_FAST else ""
+        print(f"解析OK: {filename} BPM:{bpm:.1f} Key:{camelot} (margin {key_margin:.3f}){note}")
+        info["analysis_seconds"] = time.perf_counter() - t0
+        return info
     except Exception as e:
         print(f"解析失敗: {filename} ({e})")
         return None
 
-def load_analysis_cache():
+# ============================================================
+#  ミックスポイント解析（曲全体をブロック単位でストリーミング）
+# ============================================================
+
+def analyze_mix_points(path, block=MIX_STREAM_BLOCK):
+    # RMS とオンセット包絡をブロックごとに計算して (mix_in, mix_out) 秒を返す
+    # メモリに置くのは 1 ブロック分の音声と、フレームごとの値 2 本だけ（10 分の曲でも数百 KB）
+    load_analysis_stack()
+    sr = librosa.get_samplerate(path)
+    hop = FEATURE_HOP * sr // ANALYSIS_SR
+    n_fft = 4 * hop
+    mel = librosa.filters.mel(sr=sr, n_fft=n_fft)
+    rms, onset = [], []
+    prev = None
+    for y in librosa.stream(path, block_length=block, frame_length=n_fft, hop_length=hop, mono=True):
+        if len(y) < n_fft:
+            break
+        rms.append(librosa.feature.rms(y=y, frame_length=n_fft, hop_length=hop, center=False)[0])
+        # onset_strength と同じ「対数メルの正の差分の中央値」を、ブロック境界をまたいで前フレームから続ける
+        S = np.abs(librosa.stft(y, n_fft=n_fft, hop_length=hop, center=False)) ** 2
+        M = librosa.power_to_db(mel @ S, top_db=None)
+        if prev is None:
+            prev = np.full_like(M[:, :1], -100.0)   # 曲頭の前は無音（power_to_db の下限）
+        ref = np.concatenate([prev, M[:, :-1]], axis=1)
+        onset.append(np.median(np.maximum(0.0, M - ref), axis=0))
+        prev = M[:, -1:]
+
+    if not rms:
+        return 0.0, None
+    rms, onset = np.concatenate(rms), np.concatenate(onset)
+    times = (np.arange(len(rms)) * hop + n_fft // 2) / sr
+    return find_mix_points(times, rms, onset, sf.info(path).duration)
+
+def find_mix_points(times, rms, onset, duration):
+    db = 20 * np.log10(np.maximum(rms, 1e-10))
+    level = np.percentile(db, 90)   # 曲の基準音量（サビなど大きい部分）
+    audible = np.flatnonzero(db > level - MIX_SILENCE_DB)
+    body = np.flatnonzero(db > level - MIX_TAIL_DB)
+    if not len(audible) or not len(body):
+        return 0.0, duration
+    strong = 0.5 * np.percentile(onset[audible[0]:audible[-1] + 1], 95)
+
+    # ミックスイン: 無音を飛ばし、鳴り始めから MIX_SNAP 秒以内の最初の強いオンセットから入る
+    start = times[audible[0]]
+    near = np.flatnonzero((times >= start) & (times <= start + MIX_SNAP) & (onset >= strong))
+    mix_in = max(0.0, (times[near[0]] if len(near) else start) - MIX_PREROLL)
+
+    # ミックスアウト: 余韻・フェードアウトに入る手前でフェードを終える
+    # フェード開始が直前 MIX_SNAP 秒で最も強いオンセットに乗るよう、少しだけ前へずらす
+    end = min(duration, times[body[-1]])
+    fade = (times > end - CROSSFADE_TIME - MIX_SNAP) & (times <= end - CROSSFADE_TIME)
+    if onset[fade].max(initial=0.0) >= strong:
+        end = times[fade][np.argmax(onset[fade])] + CROSSFADE_TIME
+    if end - mix_in < 2 * CROSSFADE_TIME:
+        return 0.0, duration
+    return float(mix_in), float(end)
+
+# ============================================================
+#  解析キャッシュ（SQLite・サイズ/mtime/フィンガープリントで無効化）
+# ============================================================
+
+def file_fingerprint(path, size):
+    # サイズと先頭・中央・末尾の一部だけを読む高速フィンガープリント
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode())
+    with open(path, "rb") as f:
+        for pos in (0, max(0, size // 2 - FINGERPRINT_CHUNK // 2), max(0, size - FINGERPRINT_CHUNK)):
+            f.seek(pos)
+            h.update(f.read(FINGERPRINT_CHUNK))
+    return h.hexdigest()
+
+def open_analysis_cache(path=ANALYSIS_DB):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS analysis (
+            filename    TEXT PRIMARY KEY,
+            size        INTEGER NOT NULL,
+            mtime_ns    INTEGER NOT NULL,
+            fingerprint TEXT NOT NULL,
+            bpm         REAL NOT NULL,
+            camelot     TEXT NOT NULL,
+            duration    REAL NOT NULL,
+            analyzed_at REAL NOT NULL
+        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_fingerprint ON analysis(fingerprint)")
+    ensure_cache_columns(conn, {"key_margin": "REAL", "tier": f"INTEGER NOT NULL DEFAULT {TIER_FULL}",
+                                "mix_in": "REAL", "mix_out": "REAL"})
+    conn.commit()
+    return conn
+
+def ensure_cache_columns(conn, columns):
+    # 後から増えた列を既存 DB に追加する
+    have = {r["name"] for r in conn.execute("PRAGMA table_info(analysis)")}
+    for name, decl in columns.items():
+        if name not in have:
+            conn.execute(f"ALTER TABLE analysis ADD COLUMN {name} {decl}")
+
+INFO_COLUMNS = ("bpm", "camelot", "duration", "key_margin", "fingerprint", "tier", "mix_in", "mix_out")
+
+def row_to_info(row):
+    return {k: row[k] for k in INFO_COLUMNS}
+
+def cache_get(conn, filename):
+    return conn.execute("SELECT * FROM analysis WHERE filename = ?", (filename,)).fetchone()
+
+def cache_all(conn):
+    # 起動時の確認用に全行を 1 回の SELECT で読む（ファイル名 → (size, mtime_ns, info)）
+    # 行ごとの SELECT や sqlite3.Row を作らないので 5 万曲でも 1 回のスキャンで済む
+    cur = conn.cursor()
+    cur.row_factory = None
+    cur.execute(f"SELECT filename, size, mtime_ns, {', '.join(INFO_COLUMNS)} FROM analysis")
+    return {r[0]: (r[1], r[2], dict(zip(INFO_COLUMNS, r[3:]))) for r in cur}
+
+def cache_find_fingerprint(conn, fingerprint):
+    return conn.execute(
+        "SELECT * FROM analysis WHERE fingerprint = ? LIMIT 1", (fingerprint,)
+    ).fetchone()
+
+def cache_upsert(conn, filename, st, fingerprint, info):
+    old = cache_get(conn, filename)
+    conn.execute(
+        """INSERT INTO analysis (filename, size, mtime_ns, fingerprint, bpm, camelot, duration,
+                                  key_margin, tier, mix_in, mix_out, analyzed_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT(filename) DO UPDATE SET
+               size = excluded.size, mtime_ns = excluded.mtime_ns,
+               fingerprint = excluded.fingerprint, bpm = excluded.bpm,
+               camelot = excluded.camelot, duration = excluded.duration,
+               key_margin = excluded.key_margin, tier = excluded.tier,
+               mix_in = excluded.mix_in, mix_out = excluded.mix_out,
+               analyzed_at = excluded.analyzed_at""",
+        (filename, st.st_size, st.st_mtime_ns, fingerprint,
+         info["bpm"], info["camelot"], info["duration"], info.get("key_margin"),
+         info.get("tier", TIER_FULL), info.get("mix_in"), info.get("mix_out"), time.time())
+    )
+    # 中身が変わってフィンガープリントが替わったら、どこからも参照されない旧特徴量を消す
+    if old and old["fingerprint"] and old["fingerprint"] != fingerprint \
+            and cache_find_fingerprint(conn, old["fingerprint"]) is None:
+        delete_features(old["fingerprint"])
+
+def cache_delete(conn, filenames):
+    rows = [cache_get(conn, fn) for fn in filenames]
+    conn.executemany("DELETE FROM analysis WHERE filename = ?", [(fn,) for fn in filenames])
+    # どの曲からも参照されなくなった特徴量を消す
+    for fp in {r["fingerprint"] for r in rows if r}:
+        if cache_find_fingerprint(conn, fp) is None:
+            delete_features(fp)
+
+def migrate_json_cache(conn, music_folder, stats):
+    # 旧 analysis_results.json があれば初回だけ取り込む（DB が空のときのみ）
     if not os.path.exists(ANALYSIS_JSON):
-        return {}
+        return
+    if conn.execute("SELECT 1 FROM analysis LIMIT 1").fetchone():
+        return
     try:
         with open(ANALYSIS_JSON, "r", encoding="utf-8") as f:
-            return json.load(f)
+            legacy = json.load(f)
     except Exception:
-        return {}
+        return
 
-def save_analysis_cache(cache):
-    with open(ANALYSIS_JSON, "w", encoding="utf-8") as f:
-        json.dump(dict(sorted(cache.items())), f, indent=2, ensure_ascii=False)
+    n = 0
+    for fn, info in legacy.items():
+        st = stats.get(fn)
+        if st is None:
+            continue
+        fp = file_fingerprint(os.path.join(music_folder, fn), st.st_size)
+        cache_upsert(conn, fn, st, fp, info)
+        n += 1
+    conn.commit()
+    print(f"📦 旧キャッシュ {n} 曲を SQLite へ移行しました")
 
-def analyze_tracks_with_cache(music_folder):
-    files = sorted(f for f in os.listdir(music_folder) if f.lower().endswith(".wav"))
-    cache = load_analysis_cache()
+# ============================================================
+#  特徴量ストア（曲ごとの非圧縮 npz を、使う時に配列単位で memmap）
+# ============================================================
 
-    for fn in files:
-        if fn not in cache:
-            info = analyze_single_track(music_folder, fn)
-            if info:
-                cache[fn] = info
-
-    for fn in list(cache.keys()):
-        if fn not in files:
-            cache.pop(fn)
-
-    save_analysis_cache(cache)
-
-    tracks = []
-    for fn, info in cache.items():
-        tracks.append(
-            Track(
-                filepath=os.path.join(music_folder, fn),
-                bpm=info["bpm"],
-                camelot=info["camelot"],
-                duration=info["duration"]
-            )
-        )
+#  data/features/<fp 先頭2文字>/<fingerprint>.npz
+#    beats  (n,)      float32  ビート時刻（曲頭からの秒）
+#    onset  (m,)      float16  オンセット包絡（FEATURE_HOP ごと）
+#    chroma (12, m/P) float16  クロマ（FEATURE_CHROMA_POOL フレームずつ平均）
+#    meta   (3,)      float64  [解析区間の開始秒, onset のフレーム間隔秒, chroma のフレーム間隔秒]
+#  非圧縮 zip の中身は .npy がそのまま並んでいるので、ヘッダ位置から直接 memmap できる
+
+def feature_path(fingerprint):
+    return os.path.join(FEATURE_DIR, fingerprint[:2], fingerprint + ".npz")
+
+def save_features(fingerprint, offset, sr, beats, onset, chroma):
+    cols = chroma.shape[1] // FEATURE_CHROMA_POOL * FEATURE_CHROMA_POOL
+    if cols:
+        chroma = chroma[:, :cols].reshape(12, -1, FEATURE_CHROMA_POOL).mean(axis=2)
+    hop = FEATURE_HOP / sr
+    path = feature_path(fingerprint)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f,
+                 beats=(np.asarray(beats) + offset).astype(np.float32),
+                 onset=np.asarray(onset, dtype=np.float16),
+                 chroma=np.ascontiguousarray(chroma, dtype=np.float16),
+                 meta=np.array([offset, hop, hop * (FEATURE_CHROMA_POOL if cols else 1)]))
+    os.replace(tmp, path)
+
+def delete_features(fingerprint):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(feature_path(fingerprint))
+
+class TrackFeatures:
+    # 開いた時点では zip の目次だけ読む。各配列は最初に触った時に読み取り専用 memmap にする
+    def __init__(self, path):
+        self.path = path
+        with zipfile.ZipFile(path) as z:
+            self.members = {i.filename[:-4]: i.header_offset for i in z.infolist()
+                            if i.compress_type == zipfile.ZIP_STORED}
+        self.arrays = {}
+
+    def __getitem__(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = self._map(self.members[name])
+        return self.arrays[name]
+
+    def _map(self, header_offset):
+        with open(self.path, "rb") as f:
+            f.seek(header_offset)
+            local = f.read(30)   # zip ローカルファイルヘッダ
+            name_len, extra_len = struct.unpack("<HH", local[26:30])
+            f.seek(header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                           else np.lib.format.read_array_header_2_0)
+            shape, fortran, dtype = read_header(f)
+            offset = f.tell()
+        if not np.prod(shape):
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode="r", offset=offset, shape=shape,
+                         order="F" if fortran else "C")
+
+    @property
+    def beats(self):
+        return self["beats"]
+
+    @property
+    def onset(self):
+        return self["onset"]
+
+    @property
+    def chroma(self):
+        return self["chroma"]
+
+    @property
+    def offset(self):
+        return float(self["meta"][0])
+
+    def onset_times(self):
+        return self.offset + np.arange(len(self.onset)) * float(self["meta"][1])
+
+    def chroma_times(self):
+        return self.offset + np.arange(self.chroma.shape[1]) * float(self["meta"][2])
+
+def load_features(fingerprint):
+    try:
+        return TrackFeatures(feature_path(fingerprint))
+    except (FileNotFoundError, zipfile.BadZipFile):
+        return None
+
+def lookup_cached(conn, music_folder, fn, st):
+    # キャッシュ済みなら (info, fingerprint)、未解析なら (None, fingerprint)
+    row = cache_get(conn, fn)
+    if row and row["size"] == st.st_size and row["mtime_ns"] == st.st_mtime_ns:
+        return row_to_info(row), row["fingerprint"]
+
+    # サイズか mtime が変わった（または新規）→ 中身で同一性を確認
+    fp = file_fingerprint(os.path.join(music_folder, fn), st.st_size)
+    hit = row if row and row["fingerprint"] == fp else cache_find_fingerprint(conn, fp)
+    if hit:
+        info = row_to_info(hit)
+        cache_upsert(conn, fn, st, fp, info)
+        return info, fp
+    return None, fp
+
+def make_track(music_folder, fn, info):
+    return Track(
+        filepath=os.path.join(music_folder, fn),
+        bpm=info["bpm"],
+        camelot=info["camelot"],
+        duration=info["duration"],
+        key_margin=info.get("key_margin"),
+        fingerprint=info.get("fingerprint"),
+        mix_in=info.get("mix_in"),
+        mix_out=info.get("mix_out")
+    )
+
+def scan_music_folder(music_folder):
+    with os.scandir(music_folder) as it:
+        stats = {e.name: e.stat() for e in it if e.is_file() and e.name.lower().endswith(".wav")}
+    return dict(sorted(stats.items()))
+
+def analyze_missing_tracks(music_folder, missing, conn, workers=ANALYSIS_WORKERS, tier=TIER_FULL):
+    # 未解析曲をプロセスプールで並列解析し、CACHE_SAVE_EVERY 曲ごとにコミットする
+    # missing: {filename: (stat, fingerprint)}
+    total = len(missing)
+    results = {}
+    failed = []
+    pending = 0
+
+    def collect(i, fn, info):
+        nonlocal pending
+        if info:
+            st, fp = missing[fn]
+            info["fingerprint"] = fp
+            cache_upsert(conn, fn, st, fp, info)
+            results[fn] = info
+            pending += 1
+            # 解析はワーカープロセス内で計測し、結果と一緒に受け取る
+            metrics.observe("numa_track_analysis_seconds", info.get("analysis_seconds", 0.0))
+            metrics.inc("numa_tracks_analyzed_total")
+        else:
+            failed.append(fn)
+            metrics.inc("numa_track_analysis_failures_total")
+        print(f"[{i}/{total}] {fn}")
+        if pending >= CACHE_SAVE_EVERY:
+            conn.commit()
+            pending = 0
+
+    label = "簡易解析" if tier == TIER_FAST else "解析"
+    print(f"🔍 未解析 {total} 曲を{label}します（{workers} プロセス）")
+    t0 = time.time()
+    # fork するワーカーが読み込み済みの librosa を引き継げるよう、プール作成前に読む
+    load_analysis_stack()
+
+    if workers <= 1:
+        for i, fn in enumerate(missing, 1):
+            collect(i, fn, analyze_single_track(music_folder, fn, missing[fn][1], tier))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            futures = {ex.submit(analyze_single_track, music_folder, fn, fp, tier): fn
+                       for fn, (_, fp) in missing.items()}
+            for i, fut in enumerate(as_completed(futures), 1):
+                fn = futures[fut]
+                try:
+                    info = fut.result()
+                except Exception as e:
+                    # ワーカープロセス自体が落ちた場合もその曲だけ失敗扱い
+                    print(f"解析失敗: {fn} ({e})")
+                    info = None
+                collect(i, fn, info)
+
+    conn.commit()
+
+    print(f"✅ 解析完了: {total - len(failed)}/{total} 曲 ({time.time() - t0:.1f}s)")
+    if failed:
+        print(f"⚠ 解析失敗 {len(failed)} 曲:")
+        for fn in failed:
+            print(f"   - {fn}")
+    return results, failed
+
+def analysis_complete(info, tier):
+    # 簡易解析の値や、ミックスポイントが無い本解析の値は、本解析を求められたら解析し直す
+    if info["tier"] < tier:
+        return False
+    return tier < TIER_FULL or not MIX_POINTS or info.get("mix_out") is not None
+
+def analyze_tracks_with_cache(music_folder, workers=ANALYSIS_WORKERS, tier=TIER_FULL):
+    # tier=TIER_FAST なら未解析曲は簡易解析だけ行う（AnalysisRefiner が後で本解析に置き換える）
+    with metrics.timer("analysis"):
+        return _analyze_tracks_with_cache(music_folder, workers, tier)
+
+def _analyze_tracks_with_cache(music_folder, workers, tier):
+    t0 = time.perf_counter()
+    stats = scan_music_folder(music_folder)
+    conn = open_analysis_cache()
+    migrate_json_cache(conn, music_folder, stats)
+
+    infos = {}
+    missing = {}
+    rows = cache_all(conn)
+    for fn, st in stats.items():
+        row = rows.get(fn)
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            info = row[2]
+            fp = info["fingerprint"]
+        else:
+            # 新規・変更された曲だけフィンガープリントで同一性を確認
+            info, fp = lookup_cached(conn, music_folder, fn, st)
+        if info and analysis_complete(info, tier):
+            infos[fn] = info
+        else:
+            missing[fn] = (st, fp)
+
+    # フォルダから消えた曲はキャッシュからも削除
+    removed = [fn for fn in rows if fn not in stats]
+    cache_delete(conn, removed)
+    conn.commit()
+    print(f"⚡ キャッシュ確認: {len(infos)}/{len(stats)} 曲ヒット ({(time.perf_counter() - t0) * 1000:.0f}ms)")
+    metrics.observe("numa_stage_seconds", time.perf_counter() - t0, stage="cache_check")
+    metrics.set("numa_library_tracks", len(stats))
+    metrics.set("numa_cache_hits", len(infos))
+
+    if missing:
+        results, _ = analyze_missing_tracks(music_folder, missing, conn, workers, tier)
+        infos.update(results)
+    conn.close()
+
+    tracks = [make_track(music_folder, fn, infos[fn]) for fn in sorted(infos)]
+
+    uncertain = [t.filename for t in tracks if t.key_uncertain]
+    if uncertain:
+        print(f"⚠ Key 判定の信頼度が低い曲: {len(uncertain)} 曲")
+        for fn in uncertain:
+            print(f"   - {fn}")
     return tracks
 
 # ============================================================
 #  プレイリスト生成
 # ============================================================
 
+class BpmIndex:
+    # 曲 index を BPM 昇順のスロット（同一 BPM は 1 スロット）に並べた静的インデックス
+    # 削除は removed フラグ＋「次の生存スロット」への union-find で償却ほぼ O(1)
+    def __init__(self, items, removed):
+        self.removed = removed
+        self.bpms, self.members = [], []
+        for bpm, i in sorted(items):
+            if self.bpms and self.bpms[-1] == bpm:
+                self.members[-1].append(i)
+            else:
+                self.bpms.append(bpm)
+                self.members.append([i])
+        k = len(self.bpms)
+        self.heads = [0] * k
+        self.right = list(range(k + 1))      # right[s]: s 以上で最初の生存スロット（k は番兵）
+        self.left = list(range(k + 1))       # left[s+1]: s 以下で最初の生存スロット + 1（0 は番兵）
+
+    @staticmethod
+    def _find(parent, s):
+        root = s
+        while parent[root] != root:
+            root = parent[root]
+        while parent[s] != root:
+            parent[s], s = root, parent[s]
+        return root
+
+    def _head(self, s):
+        # スロット s の生存曲のうち最小の index（いなければスロットを死なせて None）
+        members, h = self.members[s], self.heads[s]
+        while h < len(members) and self.removed[members[h]]:
+            h += 1
+        self.heads[s] = h
+        if h < len(members):
+            return members[h]
+        self.right[s] = s + 1
+        self.left[s + 1] = s
+        return None
+
+    def nearest(self, bpm):
+        # bpm の直上・直下の生存スロットから 1 曲ずつ候補を返す
+        pos = bisect.bisect_left(self.bpms, bpm)
+        found = []
+        s = pos
+        while True:
+            s = self._find(self.right, s)
+            if s == len(self.bpms):
+                break
+            i = self._head(s)
+            if i is not None:
+                found.append(i)
+                break
+        s = pos
+        while True:
+            s = self._find(self.left, s)
+            if s == 0:
+                break
+            i = self._head(s - 1)
+            if i is not None:
+                found.append(i)
+                break
+        return found
+
 def sort_playlist(tracks, start_track):
-    remaining = tracks.copy()
-    remaining.remove(start_track)
-    playlist = [start_track]
+    # 貪欲法（直前の曲から BPM 差 - ハーモニックボーナス が最小の曲を次に選ぶ）
+    # 同点は元の tracks 順で先の曲。候補は「全曲で BPM 最近傍」と「相性の良い Key ごとの BPM 最近傍」だけ見ればよい
+    n = len(tracks)
+    codes = [camelot_code(t.camelot) for t in tracks]
+    removed = [False] * n
+
+    all_index = BpmIndex([(t.bpm, i) for i, t in enumerate(tracks)], removed)
+    by_key = {}
+    for i, c in enumerate(codes):
+        if c >= 0:
+            by_key.setdefault(c, []).append((tracks[i].bpm, i))
+    key_index = {c: BpmIndex(items, removed) for c, items in by_key.items()}
+
+    current = tracks.index(start_track)
+    removed[current] = True
+    order = [current]
+
+    for _ in range(n - 1):
+        last, lc = tracks[current], codes[current]
+        cands = all_index.nearest(last.bpm)
+        if lc >= 0:
+            for c in HARMONIC_NEIGHBOURS[lc]:
+                if c in key_index:
+                    cands.extend(key_index[c].nearest(last.bpm))
+
+        best, best_score = None, None
+        for i in cands:
+            score = abs(tracks[i].bpm - last.bpm)
+            if lc >= 0 and codes[i] >= 0 and HARMONIC_TABLE[lc][codes[i]]:
+                score -= HARMONIC_BONUS
+            if best is None or score < best_score or (score == best_score and i < best):
+                best, best_score = i, score
+
+        removed[best] = True
+        order.append(best)
+        current = best
+
+    return [tracks[i] for i in order]
+
+def transition_cost(a, b):
+    # 1 遷移のコスト（sort_playlist と同じ: BPM 差 - ハーモニックボーナス）
+    cost = abs(a.bpm - b.bpm)
+    if is_harmonic(a.camelot, b.camelot):
+        cost -= HARMONIC_BONUS
+    return cost
+
+def replan_window(head, window, tail=None):
+    # head（割り込んだリクエスト曲）→ window の全曲 → tail（窓の次の曲、固定）の
+    # 合計遷移コストが最小になる window の順序を返す。窓内のコスト行列を 1 回だけ計算し、
+    # 部分集合 DP（Held-Karp）は訪問曲数が同じ集合をまとめて 1 回の行列演算で緩和する
+    # （同じ層の異なる集合から同じ状態へは書き込まれないので、層ごとに一括代入できる）
+    k = len(window)
+    if k < 2:
+        return list(window)
+    nodes = [head, *window] + ([tail] if tail is not None else [])
+    bpm = np.array([t.bpm for t in nodes], dtype=np.float64)
+    codes = np.array([camelot_code(t.camelot) for t in nodes])
+    cost = transition_cost_block(bpm, codes, np.arange(len(nodes)))
+    inner = cost[1:k + 1, 1:k + 1]
+
+    full = (1 << k) - 1
+    bits = 1 << np.arange(k)
+    masks = np.arange(full + 1)
+    members = (masks[:, None] & bits[None, :]) != 0          # [集合, 曲] 含むか
+    popcount = members.sum(axis=1)
+    dp = np.full((full + 1, k), np.inf)
+    parent = np.full((full + 1, k), -1, dtype=np.int64)
+    dp[bits, np.arange(k)] = cost[0, 1:k + 1]
+    for size in range(1, k):
+        layer = masks[popcount == size]
+        via = dp[layer][:, :, None] + inner[None, :, :]     # [集合, 最後の曲, 次の曲]
+        best = np.argmin(via, axis=1)
+        gain = np.take_along_axis(via, best[:, None, :], axis=1)[:, 0, :]
+        rows, nxt = np.nonzero(~members[layer])
+        dp[layer[rows] | bits[nxt], nxt] = gain[rows, nxt]
+        parent[layer[rows] | bits[nxt], nxt] = best[rows, nxt]
+
+    end = dp[full] + (cost[1:k + 1, k + 1] if tail is not None else 0.0)
+    j, mask, order = int(np.argmin(end)), full, []
+    while j >= 0:
+        order.append(j)
+        j, mask = int(parent[mask, j]), mask & ~(1 << j)
+    return [window[i] for i in reversed(order)]
 
-    while remaining:
-        last = playlist[-1]
-        best, best_score = None, 9999
+# ============================================================
+#  プレイリスト最適化（遷移コスト全体を 2-opt / or-opt で改善）
+# ============================================================
 
-        for t in remaining:
-            score = abs(t.bpm - last.bpm)
-            if is_harmonic(last.camelot, t.camelot):
-                score -= 50
-            if score < best_score:
-                best, best_score = t, score
+# 不明 Key(-1) は最後の行・列（すべて False）に当たるよう 25×25 にしておく
+HARMONIC_MATRIX = np.zeros((25, 25), dtype=bool)
+HARMONIC_MATRIX[:24, :24] = HARMONIC_TABLE
+
+def transition_cost_block(bpm, codes, rows):
+    # rows 行 × 全曲 の遷移コスト（sort_playlist と同じ: BPM 差 - ハーモニックボーナス）
+    return (np.abs(bpm[rows, None] - bpm[None, :])
+            - HARMONIC_BONUS * HARMONIC_MATRIX[codes[rows, None], codes[None, :]])
+
+def nearest_transitions(bpm, codes, k):
+    # 各曲からコストの小さい遷移先 k 曲のリスト
+    # 小さいライブラリは行タイルごとに密なコスト行列、大きいライブラリは BPM 近傍だけの疎な候補から選ぶ
+    n = len(bpm)
+    if n <= OPTIMIZE_DENSE_LIMIT:
+        out = _dense_nearest(bpm, codes, k)
+    else:
+        out = _sparse_nearest(bpm, codes, k)
+    return [[j for j in row if j >= 0] for row in out.tolist()]
+
+def _dense_nearest(bpm, codes, k):
+    n = len(bpm)
+    tile = max(1, OPTIMIZE_TILE_BYTES // (8 * n))
+    out = np.empty((n, k), dtype=np.int64)
+    for start in range(0, n, tile):
+        rows = np.arange(start, min(n, start + tile))
+        block = transition_cost_block(bpm, codes, rows)
+        block[np.arange(len(rows)), rows] = np.inf
+        idx = np.argpartition(block, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(block, idx, axis=1), axis=1, kind="stable")
+        out[rows] = np.take_along_axis(idx, order, axis=1)
+    return out
+
+def _sparse_nearest(bpm, codes, k):
+    # コストは「BPM 差」か「BPM 差 - ボーナス」なので、上位候補は
+    # 全曲の BPM 近傍と、相性の良い 4 Key それぞれの BPM 近傍の中にある → 各曲 5 窓ぶんだけ評価する
+    n = len(bpm)
+    rows = np.arange(n)
+    offs = np.arange(-(k // 2 + 1), k // 2 + 1)
+    w = len(offs)
+    cand = np.full((n, 5 * w), -1, dtype=np.int64)
+
+    def windows(members, src):
+        order = members[np.argsort(bpm[members], kind="stable")]
+        p = np.searchsorted(bpm[order], bpm[src])
+        return order[np.clip(p[:, None] + offs[None, :], 0, len(order) - 1)]
+
+    cand[:, :w] = windows(rows, rows)
+    neigh_keys = np.array(HARMONIC_NEIGHBOURS + [[-1] * 4])[codes]   # (n, 4)、不明 Key は -1
+    for g in range(24):
+        members = np.flatnonzero(codes == g)
+        if len(members) == 0:
+            continue
+        for slot in range(4):
+            src = np.flatnonzero(neigh_keys[:, slot] == g)
+            if len(src):
+                cand[src, (slot + 1) * w:(slot + 2) * w] = windows(members, src)
+
+    # 行ごとに重複・自分自身・空きを除いてコスト上位 k 曲
+    cand = np.take_along_axis(cand, np.argsort(cand, axis=1), axis=1)
+    safe = np.maximum(cand, 0)
+    cost = (np.abs(bpm[:, None] - bpm[safe])
+            - HARMONIC_BONUS * HARMONIC_MATRIX[codes[:, None], codes[safe]])
+    invalid = (cand < 0) | (cand == rows[:, None])
+    invalid[:, 1:] |= cand[:, 1:] == cand[:, :-1]
+    cost[invalid] = np.inf
+
+    idx = np.argpartition(cost, k - 1, axis=1)[:, :k]
+    idx = np.take_along_axis(idx, np.argsort(np.take_along_axis(cost, idx, axis=1), axis=1, kind="stable"), axis=1)
+    out = np.take_along_axis(cand, idx, axis=1)
+    out[np.isinf(np.take_along_axis(cost, idx, axis=1))] = -1
+    return out
+
+def playlist_cost(playlist):
+    bpm = np.array([t.bpm for t in playlist], dtype=np.float64)
+    codes = np.array([camelot_code(t.camelot) for t in playlist])
+    if len(playlist) < 2:
+        return 0.0
+    return float(np.sum(np.abs(np.diff(bpm)) - HARMONIC_BONUS * HARMONIC_MATRIX[codes[:-1], codes[1:]]))
+
+def optimize_playlist(playlist, time_budget=OPTIMIZE_TIME_BUDGET, k=OPTIMIZE_NEIGHBOURS):
+    # 先頭曲は固定したまま、近傍リスト上の 2-opt / or-opt で合計遷移コストを下げる
+    t0 = time.perf_counter()
+    deadline = t0 + time_budget
+    n = len(playlist)
+    greedy_cost = playlist_cost(playlist)
+    if n < 4:
+        return playlist, {"n": n, "greedy_cost": greedy_cost, "optimized_cost": greedy_cost, "seconds": 0.0}
+
+    bpm = np.array([t.bpm for t in playlist], dtype=np.float64)
+    codes = np.array([camelot_code(t.camelot) for t in playlist])
+    neigh = nearest_transitions(bpm, codes, min(k, n - 1))
+    bl, cl = bpm.tolist(), codes.tolist()
+
+    def cost(a, b):
+        if b is None:
+            return 0.0
+        c = abs(bl[a] - bl[b])
+        if cl[a] >= 0 and cl[b] >= 0 and HARMONIC_TABLE[cl[a]][cl[b]]:
+            c -= HARMONIC_BONUS
+        return c
+
+    tour = list(range(n))
+    pos = list(range(n))
+
+    def at(p):
+        return tour[p] if p < n else None
+
+    def reindex(lo, hi):
+        for p in range(lo, hi):
+            pos[tour[p]] = p
+
+    def try_two_opt(x, y):
+        # 辺 (x,x+1) と (y,y+1) を (x,y) と (x+1,y+1) に張り替え（区間 x+1..y を反転）
+        if x < 0 or y - x < 2:
+            return False
+        a, b, c, d = tour[x], tour[x + 1], tour[y], at(y + 1)
+        gain = cost(a, b) + cost(c, d) - cost(a, c) - cost(b, d)
+        if gain <= 1e-9:
+            return False
+        tour[x + 1:y + 1] = tour[x + 1:y + 1][::-1]
+        reindex(x + 1, y + 1)
+        return True
 
-        playlist.append(best)
-        remaining.remove(best)
+    def try_or_opt(s, e, j):
+        # 区間 s..e を取り出して tour[j] の直後へ（向きはよい方）
+        if j < 0 or s - 1 <= j <= e:
+            return False
+        first, last = tour[s], tour[e]
+        p, nx = tour[s - 1], at(e + 1)
+        removed_gain = cost(p, first) + cost(last, nx) - cost(p, nx)
+        u, v = tour[j], at(j + 1)
+        add_fwd = cost(u, first) + cost(last, v) - cost(u, v)
+        add_rev = cost(u, last) + cost(first, v) - cost(u, v)
+        add = min(add_fwd, add_rev)
+        if removed_gain - add <= 1e-9:
+            return False
+        seg = tour[s:e + 1]
+        if add_rev < add_fwd:
+            seg.reverse()
+        del tour[s:e + 1]
+        jj = j if j < s else j - len(seg)
+        tour[jj + 1:jj + 1] = seg
+        reindex(min(s, jj + 1), max(e + 1, jj + 1 + len(seg)))
+        return True
 
-    return playlist
+    improved = True
+    passes = 0
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        passes += 1
+        for i in range(n):
+            if i % 64 == 0 and time.perf_counter() >= deadline:
+                break
+            a = tour[i]
+            for c in neigh[a]:
+                j = pos[c]
+                lo, hi = min(i, j), max(i, j)
+                if try_two_opt(lo, hi) or try_two_opt(lo - 1, hi - 1):
+                    improved = True
+                    break
+            if i == 0:
+                continue
+            for seg_len in (1, 2, 3):
+                e = i + seg_len - 1
+                if e >= n:
+                    break
+                moved = False
+                for end in (tour[i], tour[e]):
+                    for c in neigh[end]:
+                        if try_or_opt(i, e, pos[c]) or try_or_opt(i, e, pos[c] - 1):
+                            moved = True
+                            break
+                    if moved:
+                        break
+                if moved:
+                    improved = True
+                    break
 
-def save_playlist(playlist):
+    result = [playlist[i] for i in tour]
+    report = {
+        "n": n,
+        "greedy_cost": greedy_cost,
+        "optimized_cost": playlist_cost(result),
+        "seconds": time.perf_counter() - t0,
+        "passes": passes,
+    }
+    print(f"🧮 プレイリスト最適化: コスト {report['greedy_cost']:.1f} → {report['optimized_cost']:.1f}"
+          f" ({report['seconds']:.2f}s, {passes} pass)")
+    return result, report
+
+def build_playlist(tracks, start=None, history=None):
+    # history を渡すと HISTORY_AVOID_HOURS 以内にかかった曲をセットの後ろへ回す
+    # （まだかかっていない曲だけで並べ、最近の曲はかかった時期の古い段から順にその続きへ並べる。どの段も貪欲法のまま）
+    groups = history.partition(tracks) if history is not None else [tracks]
+    parts = []
+    with metrics.timer("playlist_build"):
+        for group in groups:
+            if not group:
+                continue
+            if parts:
+                last = parts[-1][-1]
+                first = min(group, key=lambda t: transition_cost(last, t))
+            else:
+                first = start if start in group else random.choice(group)
+            parts.append(sort_playlist(group, first))
+    if OPTIMIZE_PLAYLIST:
+        with metrics.timer("playlist_optimize"):
+            parts = [optimize_playlist(p, OPTIMIZE_TIME_BUDGET * len(p) / len(tracks))[0] for p in parts]
+    recent = [len(g) for g in groups[1:]]
+    if any(recent):
+        print(f"🕘 直近 {HISTORY_AVOID_HOURS:g} 時間にかかった {sum(recent)} 曲を、"
+              f"かかった時期の古い順にセットの後半へ回しました（段ごと {'/'.join(map(str, recent))} 曲）")
+    return [t for part in parts for t in part]
+
+def save_playlist(playlist, room=None):
     ts = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    path = os.path.join(PLAYLIST_HISTORY_DIR, f"playlist_{ts}.txt")
+    suffix = f"_{room}" if room else ""
+    path = os.path.join(PLAYLIST_HISTORY_DIR, f"playlist_{ts}{suffix}.txt")
     with open(path, "w", encoding="utf-8") as f:
         for i, t in enumerate(playlist, 1):
             f.write(f"{i:02d}: {t.filename}\n")
 
 # ============================================================
-#  クロスフェード（音量のみ・固定秒）
+#  オフライン書き出し（プレイリストをブロック単位で等パワー・クロスフェードして 1 ファイルに）
 # ============================================================
 
-def crossfade_simple(a, b, time_cf, steps):
-    for i in range(steps + 1):
-        t = i / steps
-        a.volume = 100 * (1 - t)
-        b.volume = 100 * t
-        time.sleep(time_cf / steps)
+soxr = None
+
+def load_render_stack():
+    # 書き出しに librosa は要らないので soundfile と soxr だけ読む
+    global sf, soxr
+    if sf is None:
+        import soundfile as _sf
+        sf = _sf
+    if soxr is None:
+        import soxr as _soxr
+        soxr = _soxr
+
+class TrackReader:
+    # 1 曲を sr・ステレオ・float32 で先頭から順に読む。サンプリングレートが違えば soxr でストリーミング変換
+    # start / stop（秒）を渡すとその区間だけを読む（ミックスイン/アウト位置）
+    def __init__(self, path, sr=RENDER_SR, start=None, stop=None):
+        self.f = sf.SoundFile(path)
+        native = self.f.samplerate
+        first = min(self.f.frames, int((start or 0.0) * native))
+        last = self.f.frames if stop is None else min(self.f.frames, int(stop * native))
+        self.f.seek(first)
+        self.left = max(0, last - first)   # 読み残りのフレーム数（元のサンプリングレート）
+        self.frames = int(round(self.left * sr / native))   # 変換後の長さ
+        self.resampler = None
+        if self.f.samplerate != sr:
+            self.resampler = soxr.ResampleStream(self.f.samplerate, sr, 2, dtype="float32")
+        self.buf = np.zeros((0, 2), dtype=np.float32)
+        self.eof = False
+
+    def _pull(self):
+        want = min(RENDER_BLOCK, self.left)
+        block = self.f.read(want, dtype="float32", always_2d=True)
+        self.left -= len(block)
+        self.eof = self.left == 0 or len(block) < want
+        if block.shape[1] == 1:
+            block = np.repeat(block, 2, axis=1)
+        elif block.shape[1] > 2:
+            block = block[:, :2]
+        if self.resampler is not None:
+            block = self.resampler.resample_chunk(np.ascontiguousarray(block), last=self.eof)
+        return block
+
+    def read(self, n):
+        # ちょうど n フレーム返す（曲末を過ぎた分は無音）
+        parts, have = [self.buf], len(self.buf)
+        while have < n and not self.eof:
+            block = self._pull()
+            parts.append(block)
+            have += len(block)
+        data = np.concatenate(parts) if len(parts) > 1 else self.buf
+        out, self.buf = data[:n], data[n:]
+        if len(out) < n:
+            out = np.concatenate([out, np.zeros((n - len(out), 2), dtype=np.float32)])
+        return out
+
+    def close(self):
+        self.f.close()
+
+def equal_power_ramps(n):
+    # 等パワー（cos / sin）のフェードアウト・フェードイン係数（合計パワーが一定）
+    theta = (np.arange(n, dtype=np.float32) + 0.5) / max(1, n) * (np.pi / 2)
+    return np.cos(theta)[:, None], np.sin(theta)[:, None]
+
+def render_mix(playlist, path, sr=RENDER_SR, crossfade=CROSSFADE_TIME):
+    # 各曲のミックスアウト手前 crossfade 秒と次曲のミックスイン位置を重ねて書き出す（ライブ再生と同じ位置でフェード）
+    load_render_stack()
+    t0 = time.perf_counter()
+    fade_len = int(crossfade * sr)
+    written = 0
+    skipped = []
+
+    def readers():
+        for t in playlist:
+            try:
+                yield t, TrackReader(t.filepath, sr, t.mix_in, t.mix_out)
+            except Exception as e:
+                print(f"⚠ 書き出しをスキップ: {t.filename} ({e})")
+                skipped.append(t.filename)
+
+    with sf.SoundFile(path, "w", sr, 2, subtype=RENDER_SUBTYPE) as out:
+        def write(block):
+            nonlocal written
+            out.write(np.clip(block, -1.0, 1.0))
+            written += len(block)
+
+        it = readers()
+        cur = next(it, None)
+        pos = 0   # 現在曲の読み出し済みフレーム数（前の曲とのフェードで読んだ分）
+        while cur is not None:
+            track, reader = cur
+            nxt = next(it, None)
+            remaining = reader.frames - pos
+            fade = min(fade_len, remaining, nxt[1].frames // 2) if nxt else 0
+
+            body = remaining - fade
+            while body > 0:
+                n = min(RENDER_BLOCK, body)
+                write(reader.read(n))
+                body -= n
+
+            if nxt:
+                fade_out, fade_in = equal_power_ramps(fade)
+                for start in range(0, fade, RENDER_BLOCK):
+                    n = min(RENDER_BLOCK, fade - start)
+                    write(reader.read(n) * fade_out[start:start + n]
+                          + nxt[1].read(n) * fade_in[start:start + n])
+                pos = fade
+            reader.close()
+            print(f"🎚 {track.filename}")
+            cur = nxt
+
+    seconds = time.perf_counter() - t0
+    audio = written / sr
+    report = {"path": path, "tracks": len(playlist) - len(skipped), "skipped": skipped,
+              "audio_seconds": audio, "seconds": seconds,
+              "speed": audio / seconds if seconds > 0 else float("inf")}
+    metrics.observe("numa_stage_seconds", seconds, stage="render")
+    metrics.set("numa_render_speed_factor", report["speed"])
+    print(f"💿 書き出し完了: {path} ({audio / 60:.1f}分 / {seconds:.1f}s, 実時間の {report['speed']:.0f} 倍)")
+    return report
 
 # ============================================================
-#  DJ ミックス本体（改善版：ロードとフェードを分離、1曲につき1回だけ実行）
+#  タイムライン（monotonic 時刻でコールバックを予約・発火）
 # ============================================================
 
-def find_track_by_name(name, tracks):
-    for t in tracks:
-        if t.filename == name:
-            return t
-    return None
-
-def dj_mix_mpv(playlist, tracks):
-    deck_a = mpv.MPV()
-    deck_b = mpv.MPV()
-
-    deck_a.volume = 100
-    deck_b.volume = 0
+class Timeline:
+    # 予約は任意スレッドから、発火は run_once() を回すスレッドで行う
+    # コールバックには「予定時刻からの遅れ（秒）」が第1引数で渡る
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []
+        self.seq = itertools.count()
+
+    def at(self, when, fn, *args):
+        ev = [when, next(self.seq), fn, args, False]   # [時刻, 順序, 関数, 引数, キャンセル済み]
+        with self.cond:
+            heapq.heappush(self.heap, ev)
+            self.cond.notify()
+        return ev
+
+    def cancel(self, ev):
+        if ev is not None:
+            ev[4] = True
+
+    def run_once(self, max_wait=1.0):
+        with self.cond:
+            while self.heap and self.heap[0][4]:
+                heapq.heappop(self.heap)
+            timeout = max_wait
+            if self.heap:
+                timeout = min(max_wait, self.heap[0][0] - time.monotonic())
+            if timeout > 0:
+                self.cond.wait(timeout)
+            now = time.monotonic()
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                ev = heapq.heappop(self.heap)
+                if not ev[4]:
+                    due.append(ev)
+        for when, _, fn, args, _ in due:
+            fn(time.monotonic() - when, *args)
 
-    current_p, next_p = deck_a, deck_b
-
-    current = playlist[0]
-    index = 0
-
-    next_track = None
-    next_loaded = False  # ★ 次曲をロード済みか（ロードは1回だけ）
-    fading = False       # ★ フェード中ガード（多重発火防止）
+# ============================================================
+#  デッキ準備（次曲を一時停止のままロードして、フェード時は再開するだけにする）
+# ============================================================
 
-    print(f"▶ 再生開始: {current.filename}")
-    current_p.play(current.filepath)
+def open_deck(audio_device=None):
+    # ローカルファイルでも demuxer キャッシュを使い、一時停止中に先の数十秒を読んでおく
+    # audio_device を渡すとその出力へ鳴らす（ルームごとに別のスピーカー・配信へ）
+    opts = {"audio_device": audio_device} if audio_device else {}
+    return mpv.MPV(cache="yes", demuxer_readahead_secs=DECK_READAHEAD, demuxer_max_bytes=DECK_CACHE_BYTES, **opts)
 
-    while True:
-        time.sleep(0.25)
+def prefetch_file(path):
+    # 遅いディスク・ネットワークドライブ向けに、ファイルを OS のページキャッシュへ載せておく
+    try:
+        with open(path, "rb") as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            else:
+                f.read(DECK_PREFETCH_BYTES)
+    except OSError:
+        pass
 
-        if current_p.time_pos is None or current_p.duration is None:
-            continue
+# ============================================================
+#  DJ ミックス本体（mpv のプロパティ監視＋タイムラインで先読み・フェード・入れ替えを予約）
+# ============================================================
 
-        remaining = current_p.duration - current_p.time_pos
-
-        # ----------------------------
-        # ① 次曲を先読みロード（音量0）
-        #    ※ ここではフェードしない
-        # ----------------------------
-        preload_threshold = CROSSFADE_TIME + PRELOAD_MARGIN + 0.5
-        if (not next_loaded) and remaining <= preload_threshold:
-            req = pop_request()
-
-            if req:
-                cand = find_track_by_name(req, tracks)
-                if cand is None:
-                    print(f"⚠ リクエスト不明（スキップ）: {req}")
-                    req = None
-                else:
-                    next_track = cand
-            if next_track is None:
-                index = (index + 1) % len(playlist)
-                next_track = playlist[index]
+class DeckScheduler:
+    def __init__(self, playlist, index, board=None, queue=None, room=None, audio_device=None, history=None):
+        self.playlist = playlist
+        self.names = index
+        self.queue = queue if queue is not None else request_queue
+        self.board = board if board is not None else RequestBoard(self.queue)
+        self.room = room
+        self.history = history    # PlayHistory（None なら記録しない）
+        self.labels = {"room": room} if room else {}   # メトリクスのラベル（ルームごとに分ける）
+        self.running = True       # stop() で False（run() のループを抜ける）
+        self.index = 0
+        self.timeline = Timeline()
+        self.lock = threading.RLock()
+
+        self.current_p, self.next_p = open_deck(audio_device), open_deck(audio_device)
+        self.current_p.volume = 100
+        self.next_p.volume = 0
+        self.current = playlist[0]
+        self.next_track = None
+
+        self.anchor = None        # 現デッキの (time_pos, その時の monotonic 時刻)
+        self.durations = {}
+        self.preload_ev = None
+        self.fade_ev = None
+        self.preloaded = False    # ★ 次曲をロード済みか（ロードは1回だけ）
+        self.fading = False       # ★ フェード中ガード（多重発火防止）
+        self.timing = {}          # 今の遷移のタイミング計測
+        self.first_sound = False  # 起動後最初の再生位置を受け取ったか（起動時間の計測用）
+        self.load_started = None  # 次曲ロード開始の monotonic 時刻（デコード開始待ちの計測用）
+        self.next_ready = False   # 次デッキが一時停止のままロードを終えたか（warm）
+        self.start_requested = None  # 次デッキの再開を指示した (monotonic 時刻, warm か)
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)   # ページキャッシュ先読み用
+        self.prefetched = None
+        self.transitions = []     # 遷移ごとのタイミング誤差の記録
+        self.skipping = False     # skip() でフェードを前倒し中（曲末からの再予約をしない）
+        self.listeners = []       # 再生状態のイベントを受け取る関数（コントロールサーバーなど）
+
+        for deck in (self.current_p, self.next_p):
+            deck.observe_property("time-pos", lambda _n, v, deck=deck: self._on_time_pos(deck, v))
+            deck.observe_property("duration", lambda _n, v, deck=deck: self._on_duration(deck, v))
+
+        # 前回落ちた時に待っていたリクエスト・票と、停止中に Node・CLI が追記した分を受け付け直す
+        if self.board.drain(index):
+            print(f"📨 リクエスト待ち {len(self.board)} 曲を復元しました")
+
+    # ---------- mpv イベントスレッドから呼ばれる ----------
+
+    def _on_duration(self, deck, value):
+        with self.lock:
+            self.durations[id(deck)] = value
+            if deck is self.current_p:
+                self._reschedule()
+
+    def _on_time_pos(self, deck, value):
+        with self.lock:
+            if deck is self.next_p and value is not None:
+                self._on_next_pos(value)
+            if deck is not self.current_p or value is None:
+                return
+            if not self.first_sound:
+                self.first_sound = True
+                startup = time.perf_counter() - STARTUP_T0
+                metrics.set("numa_startup_seconds", startup, **self.labels)
+                print(f"🚀 起動から再生開始まで {startup:.2f}s")
+            self.anchor = (value, time.monotonic())
+            self._reschedule()
+
+    def _on_next_pos(self, value):
+        now = time.monotonic()
+        if self.load_started is not None:
+            # 一時停止中のデッキに再生位置が出た = オープン・demux が済んでデコードできる状態
+            load = now - self.load_started
+            self.timing["deck_load"] = load
+            metrics.observe("numa_deck_load_seconds", load, **self.labels)
+            self.load_started = None
+            self.next_ready = True
+        elif self.start_requested is not None and value > (self.next_track.mix_in or 0.0):
+            # 再開後に再生位置が進んだ = 音が出始めた
+            requested, warm = self.start_requested
+            state = "warm" if warm else "cold"
+            start = now - requested
+            self.timing["deck_start"] = start
+            metrics.observe("numa_deck_start_seconds", start, deck=state, **self.labels)
+            print(f"▶️ 次デッキ開始（{state}）{start * 1000:.1f}ms")
+            self.start_requested = None
+
+    def _prefetch(self, track):
+        if track.filepath != self.prefetched:
+            self.prefetched = track.filepath
+            self.prefetcher.submit(prefetch_file, track.filepath)
+
+    def _reschedule(self):
+        # 現在位置から曲末の monotonic 時刻を推定し、先読み・フェード開始を予約し直す
+        duration = self._end_pos()
+        if self.anchor is None or duration is None:
+            return
+        pos, mono = self.anchor
+        end_at = mono + (duration - pos)
+        if not self.preloaded:
+            self.preload_ev = self._retarget(self.preload_ev, end_at - PRELOAD_LEAD, self._preload)
+        if not self.fading and not self.skipping:
+            self.fade_ev = self._retarget(self.fade_ev, end_at - CROSSFADE_TIME, self._start_fade)
+
+    def _end_pos(self):
+        # フェードを終える再生位置。ミックスアウト位置が解析済みなら曲末の余韻・無音より手前で終える
+        duration = self.durations.get(id(self.current_p))
+        mix_out = self.current.mix_out
+        if duration is not None and mix_out is not None:
+            return min(duration, mix_out)
+        return duration
+
+    def _load(self, deck, track):
+        # ミックスイン位置（曲頭の無音を飛ばした最初の拍）から再生する
+        deck.start = f"{track.mix_in or 0.0:.3f}"
+        deck.loadfile(track.filepath)
+
+    def _retarget(self, ev, when, fn):
+        if ev is not None and not ev[4] and abs(ev[0] - when) < SCHEDULE_RESYNC:
+            return ev
+        self.timeline.cancel(ev)
+        return self.timeline.at(when, fn)
+
+    # ---------- タイムラインから呼ばれる ----------
+
+    def _preload(self, late):
+        # ① 次曲を一時停止のままロード（demuxer キャッシュを満たしておく）※ ここではフェードしない
+        with self.lock:
+            if self.preloaded:
+                return
+            self.timing = {"preload_late": late}
+
+            self.board.drain(self.names)
+            # リクエストはデッキに載せ終えてから消費済みになる（ロード前に落ちても次の起動で戻る）
+            cand = self.board.pop(self.current, self._load_next)
+            if cand is not None:
+                self._replan(cand)
+                self._emit("queue", pending=self.board.pending())
+            else:
+                self.index = (self.index + 1) % len(self.playlist)
+                self._load_next(self.playlist[self.index])
+            self._emit("next", request=cand is not None, **track_event(self.next_track))
+            self.preloaded = True
+
+    def _load_next(self, track):
+        self.next_track = track
+        print(f"📥 次曲ロード: {track.filename}")
+        self._prefetch(track)
+        self.load_started = time.monotonic()
+        self.next_ready = False
+        self.next_p.pause = True
+        self.next_p.volume = 0
+        self.next_p.speed = 1.0
+        self._load(self.next_p, track)
+
+    def _start_fade(self, late):
+        # ② フェード開始（本当に最後の CROSSFADE_TIME だけ）。音量変化はタイムラインに予約するだけ
+        with self.lock:
+            if self.fading:
+                return
+            if not self.preloaded:
+                # 先読みより前にフェードが来た（skip）→ ここでロードし、予約済みの先読みは取り消す
+                self.timeline.cancel(self.preload_ev)
+                self._preload(0.0)
+            self.fading = True
+            self.timing["fade_late"] = late
+            pos, duration = self.current_p.time_pos, self._end_pos()
+            if pos is not None and duration is not None and not self.skipping:
+                # 正: 予定より早くフェード開始 / 負: 遅れて開始（skip は予定を前倒ししただけなので誤差に数えない）
+                self.timing["fade_pos_error"] = (duration - pos) - CROSSFADE_TIME
+            print("🔀 クロスフェード開始")
 
-            print(f"📥 次曲ロード: {next_track.filename}")
+            # 準備済みのデッキは再開するだけ。ロードが間に合っていなければ cold として記録される
+            t0 = time.monotonic()
+            self.start_requested = (t0, self.next_ready)
+            self.next_p.pause = False
+            for i in range(1, FADE_STEPS + 1):
+                self.timeline.at(t0 + CROSSFADE_TIME * i / FADE_STEPS, self._ramp, i)
+            self._ramp(0.0, 0)
+
+    def _ramp(self, late, i):
+        with self.lock:
+            t = i / FADE_STEPS
+            self.current_p.volume = 100 * (1 - t)
+            self.next_p.volume = 100 * t
+            self.timing["ramp_late_max"] = max(self.timing.get("ramp_late_max", 0.0), late)
+            if i == FADE_STEPS:
+                self._swap()
+
+    def _swap(self):
+        # デッキ入れ替え
+        old_p = self.current_p
+        self.current_p, self.next_p = self.next_p, old_p
+        self.current = self.next_track
+
+        # 旧デッキ停止＆初期化
+        self.next_p.stop()
+        self.next_p.volume = 0
+        self.next_p.speed = 1.0
+
+        self.timing["track"] = self.current.filename
+        self.transitions.append(self.timing)
+        metrics.inc("numa_transitions_total", **self.labels)
+        for k, v in self.timing.items():
+            if isinstance(v, float):
+                metrics.observe("numa_transition_timing_seconds", abs(v), event=k, **self.labels)
+                metrics.set("numa_transition_last_seconds", v, event=k, **self.labels)
+        print("⏱ 遷移タイミング: " + ", ".join(
+            f"{k} {v * 1000:+.1f}ms" for k, v in self.timing.items() if isinstance(v, float)))
+
+        self._emit("now_playing", **track_event(self.current))
+        if self.history is not None:
+            self.history.record(self.current, self.room)
+
+        # 状態リセット（次の曲へ）
+        self.next_track = None
+        self.anchor = None
+        self.preloaded = False
+        self.next_ready = False
+        self.start_requested = None
+        self.fading = False
+        self.skipping = False
+        self.timeline.cancel(self.preload_ev)
+        self.timeline.cancel(self.fade_ev)
+        self.preload_ev = self.fade_ev = None
+        self._prefetch(self.playlist[(self.index + 1) % len(self.playlist)])
+        self._reschedule()
+
+    def _replan(self, request):
+        # リクエスト曲の後に続く REPLAN_WINDOW 曲だけを、リクエスト曲から繋がるよう並べ直す
+        t0 = time.perf_counter()
+        lo = self.index + 1
+        hi = min(len(self.playlist), lo + REPLAN_WINDOW)
+        window = [t for t in self.playlist[lo:hi] if t is not request]
+        if len(window) < hi - lo:
+            # リクエスト曲がすぐ先に予定されていた → 二度続けて鳴らさないよう窓から外す
+            self.playlist[lo:hi] = window
+            hi = lo + len(window)
+        tail = self.playlist[hi] if hi < len(self.playlist) else None
+        self.playlist[lo:hi] = replan_window(request, window, tail)
+        metrics.observe("numa_replan_seconds", time.perf_counter() - t0)
+
+    def _emit(self, kind, **data):
+        if self.room:
+            data["room"] = self.room
+        emit_event(self.listeners, kind, **data)
+
+    # ---------- コントロールサーバーから呼ばれる ----------
+
+    def skip(self):
+        # 今の曲を切り上げて、すぐクロスフェードを始める（フェード中なら何もしない）
+        with self.lock:
+            if self.fading:
+                return False
+            self.skipping = True
+            self.timeline.cancel(self.fade_ev)
+            self.fade_ev = self.timeline.at(time.monotonic(), self._start_fade)
+            return True
+
+    def status(self):
+        with self.lock:
+            upcoming = self.next_track or self.playlist[(self.index + 1) % len(self.playlist)]
+            return {
+                "now_playing": track_event(self.current),
+                "position": self.current_p.time_pos,
+                "duration": self.durations.get(id(self.current_p)),
+                "next": track_event(upcoming),
+                "next_loaded": self.preloaded,
+                "room": self.room,
+            }
+
+    # ---------- フォルダ監視スレッドから呼ばれる ----------
+
+    def add_track(self, track):
+        # 残りのプレイリスト（次にロードされる位置以降）で遷移コストが最も増えない位置に挿入
+        with self.lock:
+            n = len(self.playlist)
+            best, best_delta = n, None
+            for p in range(self.index + 1, n + 1):
+                prev, nxt = self.playlist[p - 1], self.playlist[p % n]
+                delta = (transition_cost(prev, track) + transition_cost(track, nxt)
+                         - transition_cost(prev, nxt))
+                if best_delta is None or delta < best_delta:
+                    best, best_delta = p, delta
+            self.playlist.insert(best, track)
+            return best
+
+    def remove_track(self, filename):
+        # プレイリストとリクエスト待ちから外す。再生中・ロード済みのデッキはそのまま最後まで鳴らす
+        self.board.remove(filename)
+        with self.lock:
+            keep = []
+            for p, t in enumerate(self.playlist):
+                if t.filename != filename:
+                    keep.append(t)
+                elif p <= self.index:
+                    self.index -= 1
+            if keep and len(keep) < len(self.playlist):
+                self.playlist[:] = keep
+                return True
+            return False
+
+    def reposition_track(self, track):
+        # 解析値が変わった曲を、まだロードしていない残りのプレイリスト内で置き直す
+        with self.lock:
+            upcoming = [p for p in range(self.index + 1, len(self.playlist)) if self.playlist[p] is track]
+            if not upcoming:
+                return None
+            for p in reversed(upcoming):
+                del self.playlist[p]
+            return self.add_track(track)
+
+    def run(self):
+        print(f"▶ 再生開始: {self.current.filename}")
+        self._load(self.current_p, self.current)
+        self._emit("now_playing", **track_event(self.current))
+        if self.history is not None:
+            self.history.record(self.current, self.room)
+        self._prefetch(self.playlist[(self.index + 1) % len(self.playlist)])
+        while self.running:
+            self.timeline.run_once()
+        for deck in (self.current_p, self.next_p):
+            deck.terminate()
+        self.prefetcher.shutdown(wait=False)
+
+    def stop(self):
+        # run() のループを抜けてデッキ（mpv）を閉じる
+        self.running = False
+        self.timeline.at(time.monotonic(), lambda _late: None)
+
+def emit_event(listeners, kind, **data):
+    # コントロールサーバーなどへ渡すイベント（listeners は event dict を受け取る関数のリスト）
+    event = {"type": kind, "ts": time.time(), **data}
+    for fn in listeners:
+        fn(event)
+
+def track_event(track):
+    return {"track": track.filename, "bpm": round(track.bpm, 1), "camelot": track.camelot,
+            "duration": track.duration}
 
-            next_p.play(next_track.filepath)
-            next_p.volume = 0
-            next_p.speed = 1.0
+# ============================================================
+#  ルーム（セッション）: 解析済みの曲と曲名インデックスを全ルームで共有し、ルームごとにミックスを回す
+# ============================================================
 
-            # mpv が time_pos を持つまで少し待つ（デコード開始待ち）
-            for _ in range(30):
-                if next_p.time_pos is not None:
-                    break
-                time.sleep(0.05)
+#  - ルームが持つのはプレイリスト（共有 Track への参照の並び）・デッキ 2 台・リクエストキューと受付だけ
+#  - Track / TrackIndex を書き換えるのはフォルダ監視と本解析だけで、変更は Engine が全ルームへ配る
+#  - ルームを増やしても解析キャッシュの読み直しや曲リストの複製は起きない
+
+def valid_room_name(name):
+    return (isinstance(name, str) and 0 < len(name) <= SESSION_NAME_MAX
+            and all(c.isascii() and (c.isalnum() or c in "-_") for c in name))
+
+class Session:
+    def __init__(self, name, tracks, index, queue=None, audio_device=None, history=None):
+        self.name = name
+        if queue is None:
+            os.makedirs(ROOM_DIR, exist_ok=True)
+            queue = RequestQueue(os.path.join(ROOM_DIR, f"{name}.jsonl"))
+        playlist = build_playlist(tracks, history=history)
+        save_playlist(playlist, name)
+        self.scheduler = DeckScheduler(playlist, index, queue=queue, room=name, audio_device=audio_device,
+                                       history=history)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.scheduler.run, daemon=True)
+        self.thread.start()
+        return self
+
+class Engine:
+    # ルームの集合。LibraryWatcher / AnalysisRefiner からは DeckScheduler と同じ呼び方で曲の変更を受け、全ルームへ配る
+    def __init__(self, index, history=None):
+        self.index = index
+        self.history = history    # 全ルームで共有する PlayHistory
+        self.sessions = {}        # ルーム名 → Session（最初に開いたものが既定ルーム）
+        self.opening = set()      # 準備中のルーム名（プレイリスト作成・mpv 起動はロックの外で行う）
+        self.listeners = []       # 全ルームの再生イベントの受け取り先
+        self.lock = threading.Lock()
+        self.running = False
+
+    def get(self, room=None):
+        with self.lock:
+            if room is None:
+                return next(iter(self.sessions.values()), None)
+            return self.sessions.get(room)
+
+    def rooms(self):
+        with self.lock:
+            return list(self.sessions.values())
+
+    def open(self, name):
+        # ルームを開く（run() 後なら再生も始める）。失敗時は ValueError（理由はコントロールサーバーの error に使う）
+        # 時間のかかる準備はロックの外で行い、ほかのルームの get() / 再生を止めない
+        if not valid_room_name(name):
+            raise ValueError("invalid_room")
+        tracks = self.index.snapshot()
+        if not tracks:
+            raise ValueError("empty_library")   # 曲がすべて消えている（プレイリストが作れない）
+        with self.lock:
+            if name in self.sessions or name in self.opening:
+                raise ValueError("room_exists")
+            if len(self.sessions) + len(self.opening) >= SESSION_MAX:
+                raise ValueError("room_limit")
+            # 既定ルームは従来どおり requests.jsonl を読む（Node のファイルキュー・CLI と互換）
+            queue = request_queue if not self.sessions and not self.opening else None
+            self.opening.add(name)
+        try:
+            session = Session(name, tracks, self.index, queue,
+                              SESSION_AUDIO_DEVICES.get(name), self.history)
+        finally:
+            with self.lock:
+                self.opening.discard(name)
+        with self.lock:
+            session.scheduler.listeners.extend(self.listeners)
+            self.sessions[name] = session
+            metrics.set("numa_sessions", len(self.sessions))
+            if self.running:
+                session.start()
+        print(f"🏠 ルームを開きました: {name}")
+        return session
+
+    def close(self, name):
+        with self.lock:
+            session = self.sessions.get(name)
+            if session is None:
+                raise ValueError("unknown_room")
+            if session is next(iter(self.sessions.values())):
+                raise ValueError("default_room")
+            del self.sessions[name]
+            metrics.set("numa_sessions", len(self.sessions))
+        session.scheduler.stop()
+        print(f"🏠 ルームを閉じました: {name}")
+
+    def subscribe(self, fn):
+        with self.lock:
+            self.listeners.append(fn)
+            for session in self.sessions.values():
+                session.scheduler.listeners.append(fn)
+
+    def add_track(self, track):
+        positions = [s.scheduler.add_track(track) for s in self.rooms()]
+        return positions[0] if positions else None   # ログ用に既定ルームでの位置を返す
+
+    def remove_track(self, filename):
+        return any([s.scheduler.remove_track(filename) for s in self.rooms()])
+
+    def reposition_track(self, track):
+        for s in self.rooms():
+            s.scheduler.reposition_track(track)
+
+    def run(self):
+        # 既定ルームは呼び出したスレッドで回し、ほかのルームはそれぞれのスレッドで回す
+        with self.lock:
+            self.running = True
+            first, *others = self.sessions.values()
+        for session in others:
+            session.start()
+        first.scheduler.run()
 
-            next_loaded = True
-            fading = False
+# ============================================================
+#  フォルダ監視（scandir の stat 差分 → 新曲は低優先度プロセスで解析して合流）
+# ============================================================
 
-        # ----------------------------
-        # ② フェード開始（本当に最後のCROSSFADE_TIMEだけ）
-        # ----------------------------
-        if next_loaded and (not fading) and remaining <= CROSSFADE_TIME:
-            fading = True
-            print("🔀 クロスフェード開始")
+def _watch_worker_init():
+    # 解析プロセスの優先度を下げ、librosa を先に読んでおく
+    if hasattr(os, "nice"):
+        os.nice(WATCH_NICE)
+    load_analysis_stack()
+
+def background_analysis_pool():
+    # 再生中のプロセスは mpv のスレッドを抱えているので fork せず spawn で起こす
+    return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_watch_worker_init)
+
+class LibraryWatcher:
+    # WATCH_INTERVAL ごとにフォルダを scandir して (サイズ, mtime) の差分を取る
+    #  - 追加・変更: キャッシュにあれば即合流、無ければ 1 プロセスのプールで解析してから合流
+    #  - 削除: キャッシュ・インデックス・プレイリストから外す
+    # 再生スレッドとはプレイリスト操作時に scheduler.lock を取るだけで、解析は別プロセスで行う
+    def __init__(self, music_folder, tracks, index, scheduler=None, interval=WATCH_INTERVAL):
+        self.music_folder = music_folder
+        self.tracks = tracks
+        self.index = index
+        self.scheduler = scheduler
+        self.interval = interval
+        self.known = {}       # ファイル名 → (サイズ, mtime_ns)  ※ 反映済み（解析失敗も含む）
+        self.inflight = {}    # 解析中の Future → (ファイル名, stat, フィンガープリント)
+        self.pool = None
+        self.conn = None
+        self.listeners = []   # 曲の追加・削除イベントの受け取り先（{"type": "catalog", ...}）
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        self.conn = open_analysis_cache()
+        # 起動時の解析で取り込めた曲を既知とする（取り込めなかった曲は最初の見直しで 1 回だけ再試行）
+        try:
+            stats = scan_music_folder(self.music_folder)
+        except OSError:
+            stats = {}
+        self.known = {fn: (st.st_size, st.st_mtime_ns) for fn, st in stats.items()
+                      if self.index.get(fn) is not None}
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception as e:
+                # 監視が止まっても再生は続ける
+                print(f"⚠ フォルダ監視エラー: {e}")
+
+    def poll(self):
+        t0 = time.perf_counter()
+        self._collect()
+        try:
+            stats = scan_music_folder(self.music_folder)
+        except FileNotFoundError:
+            return
+        busy = {fn for fn, _, _ in self.inflight.values()}
+        now = time.time()
+
+        for fn, st in stats.items():
+            sig = (st.st_size, st.st_mtime_ns)
+            if self.known.get(fn) == sig or fn in busy or now - st.st_mtime < WATCH_SETTLE:
+                continue
+            self.known[fn] = sig
+            info, fp = lookup_cached(self.conn, self.music_folder, fn, st)
+            if info:
+                self._merge(fn, info)
+            else:
+                self._submit(fn, st, fp)
+
+        removed = [fn for fn in self.known if fn not in stats]
+        for fn in removed:
+            del self.known[fn]
+            self._drop(fn)
+        cache_delete(self.conn, removed)
+        self.conn.commit()
+        metrics.observe("numa_watch_scan_seconds", time.perf_counter() - t0)
+
+    def _submit(self, fn, st, fp):
+        if self.pool is None:
+            self.pool = background_analysis_pool()
+        print(f"🔍 新曲を解析します: {fn}")
+        fut = self.pool.submit(analyze_single_track, self.music_folder, fn, fp)
+        self.inflight[fut] = (fn, st, fp)
+
+    def _collect(self):
+        for fut in [f for f in self.inflight if f.done()]:
+            fn, st, fp = self.inflight.pop(fut)
+            try:
+                info = fut.result()
+            except Exception as e:
+                print(f"解析失敗: {fn} ({e})")
+                info = None
+            if not info:
+                metrics.inc("numa_track_analysis_failures_total")
+                continue
+            metrics.observe("numa_track_analysis_seconds", info.get("analysis_seconds", 0.0))
+            metrics.inc("numa_tracks_analyzed_total")
+            if self.known.get(fn) != (st.st_size, st.st_mtime_ns):
+                continue   # 解析中に消えた・書き換わった → 次の見直しでやり直す
+            info["fingerprint"] = fp
+            cache_upsert(self.conn, fn, st, fp, info)
+            self._merge(fn, info)
+        self.conn.commit()
+
+    def _merge(self, fn, info):
+        track = make_track(self.music_folder, fn, info)
+        replaced = self.index.get(fn) is not None
+        if replaced:
+            self._drop(fn, log=False)
+        self.index.add(track)
+        self.tracks.append(track)
+        pos = self.scheduler.add_track(track) if self.scheduler else None
+        emit_event(self.listeners, "catalog", added=[track_event(track)], removed=[])
+        metrics.inc("numa_watch_changes_total", kind="changed" if replaced else "added")
+        metrics.set("numa_library_tracks", len(self.tracks))
+        where = f"（プレイリスト {pos + 1} 曲目）" if pos is not None else ""
+        print(f"➕ 曲を{'更新' if replaced else '追加'}: {fn}{where}")
+
+    def _drop(self, fn, log=True):
+        track = self.index.remove(fn)
+        if track is None:
+            return
+        self.tracks[:] = [t for t in self.tracks if t.filename != fn]
+        if self.scheduler:
+            self.scheduler.remove_track(fn)
+        if not log:
+            return
+        emit_event(self.listeners, "catalog", added=[], removed=[fn])
+        metrics.inc("numa_watch_changes_total", kind="removed")
+        metrics.set("numa_library_tracks", len(self.tracks))
+        print(f"➖ 曲を削除: {fn}")
 
-            crossfade_simple(current_p, next_p, CROSSFADE_TIME, FADE_STEPS)
+# ============================================================
+#  本解析への置き換え（簡易解析の曲を 1 曲ずつ低優先度プロセスで解析し直す）
+# ============================================================
 
-            # デッキ入れ替え
-            old_p = current_p
-            current_p, next_p = next_p, old_p
-            current = next_track
+class AnalysisRefiner:
+    # キャッシュで tier < TIER_FULL（またはミックスポイント未解析）の曲を古い順に本解析し、キャッシュと再生中の Track を更新する
+    # BPM / Key が変わった曲は、まだ再生していなければプレイリスト内の位置を置き直す
+    def __init__(self, music_folder, index, scheduler=None):
+        self.music_folder = music_folder
+        self.index = index
+        self.scheduler = scheduler
+        self.listeners = []   # 解析値が更新された曲のイベントの受け取り先
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        conn = open_analysis_cache()
+        # ミックスポイントが無い（追加前に本解析した）曲も対象
+        rows = conn.execute("SELECT filename, size, mtime_ns, fingerprint FROM analysis "
+                            "WHERE tier < ? OR (? AND mix_out IS NULL) ORDER BY analyzed_at",
+                            (TIER_FULL, MIX_POINTS)).fetchall()
+        if not rows:
+            conn.close()
+            return
+        print(f"🔬 簡易解析の {len(rows)} 曲を裏で本解析します")
+        metrics.set("numa_refine_pending", len(rows))
+        with background_analysis_pool() as pool:
+            for i, row in enumerate(rows, 1):
+                try:
+                    self.refine(conn, pool, row)
+                except Exception as e:
+                    print(f"⚠ 本解析エラー: {row['filename']} ({e})")
+                metrics.set("numa_refine_pending", len(rows) - i)
+        conn.close()
+        print("🔬 本解析への置き換え完了")
+
+    def refine(self, conn, pool, row):
+        fn, fp = row["filename"], row["fingerprint"]
+        path = os.path.join(self.music_folder, fn)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        if (st.st_size, st.st_mtime_ns) != (row["size"], row["mtime_ns"]):
+            return   # 書き換わった曲はフォルダ監視が解析し直す
+
+        info = pool.submit(analyze_single_track, self.music_folder, fn, fp, TIER_FULL).result()
+        if not info:
+            return
+        cur = cache_get(conn, fn)
+        if cur is None or (cur["size"], cur["mtime_ns"], cur["fingerprint"]) != (st.st_size, st.st_mtime_ns, fp):
+            return   # 解析中に削除・変更された
+        info["fingerprint"] = fp
+        cache_upsert(conn, fn, st, fp, info)
+        conn.commit()
+        metrics.inc("numa_tracks_refined_total")
+
+        track = self.index.get(fn)
+        if track is None:
+            return
+        moved = track.camelot != info["camelot"] or abs(track.bpm - info["bpm"]) > track.bpm * BPM_TOLERANCE / 2
+        track.bpm, track.camelot = info["bpm"], info["camelot"]
+        track.duration, track.key_margin, track.fingerprint = info["duration"], info["key_margin"], fp
+        track.mix_in, track.mix_out = info.get("mix_in"), info.get("mix_out")
+        emit_event(self.listeners, "catalog", added=[track_event(track)], removed=[])
+        if moved and self.scheduler:
+            self.scheduler.reposition_track(track)
 
-            # 旧デッキ停止＆初期化
-            next_p.stop()
-            next_p.volume = 0
-            next_p.speed = 1.0
+# ============================================================
+#  コントロールサーバー（asyncio・Unix ソケット / TCP・1 行 1 JSON）
+# ============================================================
 
-            # 状態リセット（次の曲へ）
-            next_track = None
-            next_loaded = False
-            fading = False
+#  受信: {"cmd": "request", "title": ..., "guest": ..., "id": ...}
+#        {"cmd": "skip", "id": ...} / {"cmd": "status", "id": ...}
+#        {"cmd": "catalog", "id": ...}   ※ 解析済み全曲（以後は catalog イベントで差分）
+#        {"cmd": "rooms", "id": ...} / {"cmd": "open_room" | "close_room", "room": ..., "id": ...}
+#        {"cmd": "history", "title": ..., "hours": ..., "id": ...}   ※ 最終再生時刻と直近 hours 時間の再生回数
+#        request / skip / status は "room" でルームを指定（省略時は既定ルーム）
+#  送信: {"type": "reply", "id": ..., "cmd": ..., "ok": ...}  ※ コマンドごとに必ず 1 つ
+#        {"type": "now_playing" | "next" | "queue", "room": ..., ...}    ※ 全クライアントへのイベント
+#        {"type": "catalog", "added": [...], "removed": [...]}   ※ added は追加・更新
+#  - 1 回の読み出しで届いた行は 1 バッチとして処理し、応答は 1 回の送信、queue イベントは 1 回にまとめる
+#  - リクエストは RequestBoard で受け付ける（重複は投票、ゲストごとの回数制限は result で返す）
+#  - 応答を送り切る（drain）まで次を読まない → 詰まったクライアントは TCP 側で送信が止まる
+#  - イベントは送信待ちが CONTROL_HIGH_WATER を超えたクライアントには送らず捨てる（状態は status で取り直せる）
+
+class ControlServer:
+    def __init__(self, index, engine=None, path=CONTROL_SOCKET, port=CONTROL_PORT):
+        self.index = index
+        self.engine = engine
+        self.path = path
+        self.port = port
+        self.loop = None
+        self.clients = set()
+        if engine is not None:
+            engine.subscribe(self.publish)
+
+    def start(self):
+        threading.Thread(target=lambda: asyncio.run(self.serve()), daemon=True).start()
+        return self
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        if self.path and hasattr(socket, "AF_UNIX"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+            server = await asyncio.start_unix_server(self._client, self.path)
+            where = self.path
+        else:
+            server = await asyncio.start_server(self._client, "127.0.0.1", self.port)
+            where = f"127.0.0.1:{self.port}"
+        print(f"🎛 コントロールサーバー: {where}")
+        async with server:
+            await server.serve_forever()
+
+    def publish(self, event):
+        # どのスレッドからでも呼べる
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._broadcast, event)
+
+    def _broadcast(self, event):
+        line = encode_line(event)
+        for w in list(self.clients):
+            if w.transport.get_write_buffer_size() > CONTROL_HIGH_WATER:
+                metrics.inc("numa_control_events_dropped_total")
+                continue
+            w.write(line)
+
+    async def _client(self, reader, writer):
+        self.clients.add(writer)
+        metrics.set("numa_control_clients", len(self.clients))
+        buf = b""
+        try:
+            while True:
+                chunk = await reader.read(CONTROL_READ_CHUNK)
+                if not chunk:
+                    break
+                *lines, buf = (buf + chunk).split(b"\n")
+                if len(buf) > CONTROL_LINE_LIMIT:
+                    writer.write(encode_line({"type": "error", "error": "line_too_long"}))
+                    break
+                if not lines:
+                    continue
+                t0 = time.perf_counter()
+                replies = await self.handle_batch(lines)
+                metrics.observe("numa_control_batch_seconds", time.perf_counter() - t0)
+                metrics.observe("numa_control_batch_size", len(lines))
+                writer.write(b"".join(encode_line(r) for r in replies))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(writer)
+            metrics.set("numa_control_clients", len(self.clients))
+            writer.close()
+
+    async def handle_batch(self, lines):
+        replies = []
+        queue_changed = {}   # ルーム名 → Session（待ち行列が変わったルーム）
+
+        for raw in lines:
+            if not raw.strip():
+                continue
+            try:
+                msg = json.loads(raw)
+                cmd = msg.get("cmd")
+            except (ValueError, AttributeError):
+                replies.append({"type": "error", "error": "invalid_json"})
+                continue
+            metrics.inc("numa_control_commands_total", cmd=str(cmd))
+            reply = {"type": "reply", "id": msg.get("id"), "cmd": cmd}
+            room = msg.get("room")
+            if room is not None and not valid_room_name(room):
+                reply.update(ok=False, error="invalid_room")
+                replies.append(reply)
+                continue
+            session = self.engine.get(room) if self.engine else None
+
+            if cmd in ("request", "skip", "status") and session is None:
+                reply.update(ok=False, error="unknown_room")
+            elif cmd == "request":
+                title = str(msg.get("title", ""))
+                track = self.index.resolve(title)
+                if track is None:
+                    reply.update(ok=False, error="not_found",
+                                 candidates=[t.filename for _, t in self.index.search(title, limit=3)])
+                else:
+                    guest = str(msg["guest"]) if msg.get("guest") is not None else None
+                    result, votes = session.scheduler.board.admit(track, guest, str(msg.get("source", "control")))
+                    ok = result in ("queued", "voted")
+                    if ok:
+                        queue_changed[session.name] = session
+                    reply.update(ok=ok, track=track.filename, result=result, votes=votes, room=session.name)
+                    if not ok:
+                        reply["error"] = result
+            elif cmd == "skip":
+                reply.update(ok=session.scheduler.skip(), room=session.name)
+            elif cmd == "catalog":
+                reply.update(ok=True, tracks=[track_event(t) for t in self.index.snapshot()])
+            elif cmd == "status":
+                reply.update(ok=True, queue=session.scheduler.board.pending(), **session.scheduler.status())
+            elif cmd == "rooms":
+                rooms = self.engine.rooms() if self.engine else []
+                reply.update(ok=True, rooms=[{"room": s.name, **track_event(s.scheduler.current)} for s in rooms])
+            elif cmd == "history" and self.engine is not None and self.engine.history is not None:
+                track = self.index.resolve(str(msg.get("title", "")))
+                if track is None:
+                    reply.update(ok=False, error="not_found")
+                else:
+                    try:
+                        hours = float(msg.get("hours", HISTORY_AVOID_HOURS))
+                    except (TypeError, ValueError):
+                        hours = HISTORY_AVOID_HOURS
+                    history = self.engine.history
+                    reply.update(ok=True, track=track.filename, last_played=history.last_played(track),
+                                 hours=hours, plays=history.plays_since(track, hours))
+            elif cmd in ("open_room", "close_room") and self.engine is not None:
+                # プレイリスト作成・mpv の起動停止はループの外で（その間もほかのクライアントを処理する）
+                fn = self.engine.open if cmd == "open_room" else self.engine.close
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, fn, room)
+                    reply.update(ok=True, room=room)
+                except ValueError as e:
+                    reply.update(ok=False, error=str(e), room=room)
+                except Exception as e:
+                    # mpv の起動失敗など。同じバッチのほかの返事は返せるよう、ここで止める
+                    print(f"⚠ {cmd} {room} に失敗しました ({e!r})")
+                    reply.update(ok=False, error=f"{cmd.split('_')[0]}_failed", room=room)
+            else:
+                reply.update(ok=False, error="unknown_command")
+            replies.append(reply)
+
+        # 1 バッチでルームごとに 1 回だけ待ち行列を知らせる
+        for name, session in queue_changed.items():
+            self.publish({"type": "queue", "ts": time.time(), "room": name,
+                          "pending": session.scheduler.board.pending()})
+        return replies
+
+def encode_line(obj):
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
 
 # ============================================================
 #  メイン
 # ============================================================
 
 if __name__ == "__main__":
-    tracks = analyze_tracks_with_cache(MUSIC_FOLDER)
+    ap = argparse.ArgumentParser(description="numa DJ")
+    ap.add_argument("--render", nargs="?", const="", metavar="PATH",
+                    help="再生せずにセット全体を WAV / FLAC に書き出す（パス省略時は data/renders/）")
+    ap.add_argument("--rooms", help="同時に回すルーム名（カンマ区切り・先頭が既定ルーム）")
+    args = ap.parse_args()
+    rooms = [r.strip() for r in args.rooms.split(",") if r.strip()] if args.rooms else SESSIONS
+
+    migrate_legacy_requests()
+
+    # 書き出しは待っても困らないので最初から本解析、ライブ再生は簡易解析で先に鳴らす
+    tier = TIER_FAST if ANALYSIS_TIERED and args.render is None else TIER_FULL
+    tracks = analyze_tracks_with_cache(MUSIC_FOLDER, tier=tier)
     if not tracks:
         print("再生できる曲がありません")
         exit()
 
-    start = random.choice(tracks)
-    playlist = sort_playlist(tracks, start)
-    save_playlist(playlist)
+    start_metrics_export()
+
+    with metrics.timer("index_build"):
+        index = TrackIndex(tracks)
+
+    if args.render is not None:
+        playlist = build_playlist(tracks)
+        save_playlist(playlist)
+        path = args.render
+        if not path:
+            os.makedirs(RENDER_DIR, exist_ok=True)
+            ts = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            path = os.path.join(RENDER_DIR, f"mix_{ts}.{RENDER_FORMAT}")
+        render_mix(playlist, path)
+        metrics.write()
+        exit()
+
+    # ルームごとにプレイリストとデッキを用意（曲と曲名インデックス・再生履歴は全ルームで共有）
+    engine = Engine(index, PlayHistory(PLAY_HISTORY))
+    for room in rooms:
+        try:
+            engine.open(room)
+        except ValueError as e:
+            print(f"⚠ ルーム {room} を開けません ({e})")
+    if not engine.rooms():
+        print("開けるルームがありません")
+        exit()
 
     # CLI リクエスト受付を別スレッドで起動
     threading.Thread(
         target=cli_request_loop,
-        args=(tracks,),
+        args=(index, engine),
         daemon=True
     ).start()
 
-    dj_mix_mpv(playlist, tracks)
+    watcher = LibraryWatcher(MUSIC_FOLDER, tracks, index, engine)
+    refiner = AnalysisRefiner(MUSIC_FOLDER, index, engine)
+    if CONTROL_SERVER:
+        control = ControlServer(index, engine).start()
+        watcher.listeners.append(control.publish)
+        refiner.listeners.append(control.publish)
+    if WATCH_FOLDER:
+        watcher.start()
+    refiner.start()
+    engine.run()
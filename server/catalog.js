@@ -0,0 +1,96 @@
+import fs from 'fs';
+import { CONFIG } from './config.js';
+
+// ============================================================
+//  曲カタログ（音楽フォルダのファイル一覧 ＋ Python 側の解析結果）
+//  - 起動時に 1 回だけ非同期で読み、以後はフォルダ監視と Python からの差分で更新する
+//  - ゲストには接続時にスナップショットを 1 回、以後は差分（added は追加・更新）だけを送る
+// ============================================================
+
+const RESCAN_DELAY_MS = 300;   // フォルダ変更イベントをまとめてから読み直すまでの待ち
+
+// ファイル一覧（フォルダが正）と Python の解析値は別々に持ち、送る時に合わせる
+// （Python から先に解析値が届いても、フォルダを読み終えた時点で反映される）
+let files = new Set();
+const analysis = new Map();   // title → { bpm, camelot, duration }
+let version = 0;
+const subscribers = new Set();
+
+const isMusicFile = (file) =>
+    !file.startsWith('.') && CONFIG.ALLOWED_EXTENSIONS.some(ext => file.endsWith(ext));
+
+// [title, bpm, camelot, duration] のタプルで送る（キー名を毎回送らない）。未解析は null
+const compact = (title) => {
+    const meta = analysis.get(title);
+    return [title, meta?.bpm ?? null, meta?.camelot ?? null, meta?.duration ?? null];
+};
+
+export const getTitles = () => [...files];
+
+export const getSnapshot = () => ({ version, songs: getTitles().map(compact) });
+
+// delta = { version, added: [[title, bpm, camelot, duration]], removed: [title] }
+export const onCatalogDelta = (fn) => {
+    subscribers.add(fn);
+    return () => subscribers.delete(fn);
+};
+
+const publish = (added, removed) => {
+    if (added.length === 0 && removed.length === 0) return;
+    version++;
+    const delta = { version, added: [...new Set(added)].map(compact), removed };
+    for (const fn of subscribers) fn(delta);
+};
+
+const syncFiles = (list) => {
+    const next = new Set(list);
+    const added = list.filter(f => !files.has(f));
+    const removed = getTitles().filter(f => !next.has(f));
+    files = next;
+    publish(added, removed);
+};
+
+const sameMeta = (a, b) => a && b && a.bpm === b.bpm && a.camelot === b.camelot && a.duration === b.duration;
+
+// Python の解析結果を反映する（items: [{track, bpm, camelot, duration}]）
+// full=true は全曲分のスナップショット（載っていない曲の解析値は消す）
+export const applyAnalysis = (items, removedTitles = [], full = false) => {
+    const changed = [];
+    const seen = new Set();
+    for (const it of items) {
+        seen.add(it.track);
+        const meta = { bpm: it.bpm, camelot: it.camelot, duration: it.duration };
+        if (sameMeta(analysis.get(it.track), meta)) continue;
+        analysis.set(it.track, meta);
+        changed.push(it.track);
+    }
+    const cleared = full ? [...analysis.keys()].filter(t => !seen.has(t)) : removedTitles;
+    for (const t of cleared) {
+        if (analysis.delete(t)) changed.push(t);
+    }
+    publish(changed.filter(t => files.has(t)), []);
+};
+
+const rescan = async () => {
+    try {
+        const files = await fs.promises.readdir(CONFIG.MUSIC_DIR);
+        syncFiles(files.filter(isMusicFile).sort());
+    } catch (err) {
+        if (err.code !== 'ENOENT') console.error('[Catalog] rescan failed:', err);
+        syncFiles([]);
+    }
+};
+
+export const startCatalog = async () => {
+    await rescan();
+    console.log(`[Catalog] ${files.size} songs`);
+    let timer = null;
+    try {
+        fs.watch(CONFIG.MUSIC_DIR, () => {
+            clearTimeout(timer);
+            timer = setTimeout(rescan, RESCAN_DELAY_MS);
+        });
+    } catch (err) {
+        console.error('[Catalog] folder watch unavailable:', err.message);
+    }
+};
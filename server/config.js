@@ -15,5 +15,12 @@ export const CONFIG = {
   MUSIC_DIR: path.join(__dirname, '..', 'public', 'music'),
   
   // 許可する拡張子
-  ALLOWED_EXTENSIONS: ['.wav', '.mp3']
+  ALLOWED_EXTENSIONS: ['.wav', '.mp3'],
+
+  // Python DJ（main.py）のコントロールサーバー（Windows では TCP ポート）
+  DJ_CONTROL_SOCKET: path.join(__dirname, '..', 'Python', 'data', 'control.sock'),
+  DJ_CONTROL_PORT: 8765,
+
+  // 受け持つルーム（main.py --rooms の名前）。既定ルーム（先頭）を受け持つなら null のまま
+  DJ_ROOM: process.env.DJ_ROOM || null
 };
\ No newline at end of file
@@ -4,6 +4,7 @@ import { Server } from 'socket.io';
 import { CONFIG } from './config.js';
 import router from './routes.js';
 import { setupSocket } from './socket.js';
+import { startCatalog } from './catalog.js';
 
 // アプリケーション初期化
 const app = express();
@@ -17,10 +18,13 @@ app.use('/music', express.static(CONFIG.MUSIC_DIR));
 // ここで /api 配下の処理を routes.js に委譲します
 app.use('/api', router);
 
-// 3. Socket通信設定
+// 3. 曲カタログ（起動時に 1 回読み、以後はフォルダ監視で更新）
+startCatalog();
+
+// 4. Socket通信設定
 setupSocket(io);
 
-// 4. サーバー起動
+// 5. サーバー起動
 httpServer.listen(CONFIG.PORT, () => {
   console.log(`===============================================`);
   console.log(` 🚀 DJ Server ready at http://localhost:${CONFIG.PORT}`);
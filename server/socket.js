@@ -1,92 +1,195 @@
 import fs from 'fs';
-import { spawn } from 'child_process';
+import net from 'net';
 import path from 'path';
 import { CONFIG } from './config.js';
+import { applyAnalysis, getSnapshot, onCatalogDelta } from './catalog.js';
 
-// JSONファイルのパス設定
-const REQUEST_FILE_DIR = path.join(process.cwd(), 'Python/data');
-const REQUEST_FILE_PATH = path.join(REQUEST_FILE_DIR, 'requests.json');
+// リクエストキューのパス設定（Python 側 RequestQueue と同じ追記専用 JSONL）
+// Python DJ のコントロールサーバーに繋がっていない間だけ使う
+// 既定以外のルームは Python/data/rooms/<ルーム名>.jsonl
+const REQUEST_FILE_DIR = CONFIG.DJ_ROOM
+    ? path.join(process.cwd(), 'Python/data/rooms')
+    : path.join(process.cwd(), 'Python/data');
+const REQUEST_QUEUE_PATH = path.join(REQUEST_FILE_DIR, CONFIG.DJ_ROOM ? `${CONFIG.DJ_ROOM}.jsonl` : 'requests.jsonl');
 
-// ★修正: シンプルな文字列リストとして保存する関数
-const saveRequestToJSON = (title) => {
-    try {
-        // 1. フォルダがなければ作る
-        if (!fs.existsSync(REQUEST_FILE_DIR)) {
-            fs.mkdirSync(REQUEST_FILE_DIR, { recursive: true });
-        }
+if (!fs.existsSync(REQUEST_FILE_DIR)) {
+    fs.mkdirSync(REQUEST_FILE_DIR, { recursive: true });
+}
 
-        // 2. ファイルを読み込む
-        let jsonData = { requests: [] };
-        if (fs.existsSync(REQUEST_FILE_PATH)) {
-            const fileContent = fs.readFileSync(REQUEST_FILE_PATH, 'utf-8');
-            if (fileContent.trim()) {
-                jsonData = JSON.parse(fileContent);
-            }
-        }
+// 1リクエスト = 1行で追記するだけ（読み直し・書き直しはしない）
+// 同じティック内に来たリクエストはまとめて 1 回の追記にする
+let pendingLines = [];
 
-        // 3. ★ここを変更: オブジェクトではなく「曲名の文字列」をそのまま追加
-        jsonData.requests.push(title);
+const flushRequests = () => {
+    const chunk = pendingLines.join('');
+    pendingLines = [];
+    // 追記ごとに開き直す（Python 側がファイルをローテーションしても新しいファイルに書くため）
+    fs.appendFile(REQUEST_QUEUE_PATH, chunk, (err) => {
+        if (err) console.error("[Queue Error] Failed to append request:", err);
+    });
+};
 
-        // 4. 書き込み
-        fs.writeFileSync(REQUEST_FILE_PATH, JSON.stringify(jsonData, null, 2));
-        console.log(`[Saved] Added to list: ${title}`);
+const appendRequest = (title, fields = {}) => {
+    const line = JSON.stringify({ title, ts: Date.now() / 1000, source: 'web', ...fields }) + "\n";
+    if (pendingLines.length === 0) setImmediate(flushRequests);
+    pendingLines.push(line);
+    console.log(`[Queued] ${title}`);
+};
 
-    } catch (err) {
-        console.error("[JSON Error] Failed to save request:", err);
-    }
+// ============================================================
+//  Python DJ コントロール接続（1 行 1 JSON）
+//  - 送信: 同じティック内のコマンドは 1 回の write にまとめる。write が詰まったら drain まで溜める
+//  - 受信: reply は送ったゲストへ返し、now_playing / next / queue は全員へ流す（受け持つルームの分だけ）
+//          catalog（解析値の全量・差分）は曲カタログへ反映する
+// ============================================================
+
+const RECONNECT_MIN_MS = 500;
+const RECONNECT_MAX_MS = 5000;
+
+let dj = null;              // 接続中のソケット（未接続は null）
+let djWritable = true;      // false の間は drain 待ち
+let outgoing = [];          // 未送信のコマンド行
+let inflight = new Map();   // id → { replyTo, title, sentAt }（replyTo は返事を届ける socket.id）
+let nextId = 1;
+let reconnectMs = RECONNECT_MIN_MS;
+let lastState = {};         // 新しく繋いだゲストに送る最新の now_playing / next / queue
+let djRoom = CONFIG.DJ_ROOM; // 受け持つルーム（null の間は status の返事で既定ルーム名を知る）
+
+const flushCommands = () => {
+    if (!dj || !djWritable || outgoing.length === 0) return;
+    const chunk = outgoing.join('');
+    outgoing = [];
+    djWritable = dj.write(chunk);
+};
+
+const sendCommand = (cmd, replyTo) => {
+    const id = nextId++;
+    inflight.set(id, { replyTo, title: cmd.title, sentAt: Date.now() });
+    if (outgoing.length === 0) setImmediate(flushCommands);
+    outgoing.push(JSON.stringify({ ...cmd, room: CONFIG.DJ_ROOM ?? undefined, id }) + "\n");
+    return id;
 };
 
-// Pythonプロセス管理
-let pythonProcess = null;
-
-const startPythonDJ = () => {
-    if (pythonProcess) return;
-    const scriptPath = path.join(CONFIG.ROOT_DIR, 'python', 'dj_player.py');
-    
-    if (fs.existsSync(scriptPath)) {
-        console.log(`Starting Python DJ: ${scriptPath}`);
-        pythonProcess = spawn('python3', [scriptPath]);
-
-        pythonProcess.stdout.on('data', (data) => console.log(`[Py] ${data}`));
-        pythonProcess.stderr.on('data', (data) => console.error(`[Py Err] ${data}`));
-        pythonProcess.on('close', () => { pythonProcess = null; });
-    } else {
-        console.log("Python script not found, running in frontend-only mode.");
+const connectDJ = (io) => {
+    const target = process.platform === 'win32'
+        ? { port: CONFIG.DJ_CONTROL_PORT, host: '127.0.0.1' }
+        : { path: CONFIG.DJ_CONTROL_SOCKET };
+    const sock = net.createConnection(target);
+    let buf = '';
+
+    sock.setEncoding('utf8');
+    sock.on('connect', () => {
+        console.log('[DJ] connected to Python control server');
+        dj = sock;
+        djWritable = true;
+        reconnectMs = RECONNECT_MIN_MS;
+        sendCommand({ cmd: 'status' }, null);
+        sendCommand({ cmd: 'catalog' }, null);
+    });
+    sock.on('drain', () => {
+        djWritable = true;
+        flushCommands();
+    });
+    sock.on('data', (data) => {
+        buf += data;
+        const lines = buf.split("\n");
+        buf = lines.pop();
+        for (const line of lines) {
+            if (!line) continue;
+            try {
+                handleDJMessage(io, JSON.parse(line));
+            } catch (err) {
+                console.error('[DJ] bad message:', err);
+            }
+        }
+    });
+    sock.on('error', () => {});   // close で再接続する
+    sock.on('close', () => {
+        if (dj === sock) console.log('[DJ] disconnected (requests fall back to the file queue)');
+        dj = null;
+        // まだ送っていない request はファイルキューへ回す
+        // 送信済みで返事の来なかったものは Python 側で受理済みかもしれないので入れ直さない（二重登録を避ける）
+        for (const line of outgoing) {
+            const cmd = JSON.parse(line);
+            if (cmd.cmd !== 'request') continue;
+            appendRequest(cmd.title, { guest: cmd.guest });
+            const req = inflight.get(cmd.id);
+            if (req?.replyTo) io.to(req.replyTo).emit('request_result', { ok: true, result: 'pending', title: cmd.title });
+        }
+        outgoing = [];
+        inflight = new Map();
+        setTimeout(() => connectDJ(io), reconnectMs);
+        reconnectMs = Math.min(reconnectMs * 2, RECONNECT_MAX_MS);
+    });
+};
+
+const handleDJMessage = (io, msg) => {
+    if (msg.type === 'reply') {
+        const req = inflight.get(msg.id);
+        inflight.delete(msg.id);
+        if (!req) return;
+        const latencyMs = Date.now() - req.sentAt;
+        if (msg.cmd === 'status') {
+            if (msg.ok) djRoom = msg.room;
+            if (msg.now_playing) lastState.now_playing = { type: 'now_playing', ...msg.now_playing };
+            if (msg.next) lastState.next = { type: 'next', ...msg.next };
+            lastState.queue = { type: 'queue', pending: msg.queue ?? [] };
+        }
+        if (msg.cmd === 'catalog' && msg.ok) applyAnalysis(msg.tracks ?? [], [], true);
+        if (msg.cmd === 'request') {
+            console.log(`[DJ] request ${msg.ok ? 'accepted' : 'rejected'}: ${msg.track ?? msg.error} (${latencyMs}ms)`);
+        }
+        if (req.replyTo) io.to(req.replyTo).emit('request_result', { ...msg, title: req.title, latencyMs });
+        return;
+    }
+    if (msg.type === 'catalog') {
+        applyAnalysis(msg.added ?? [], msg.removed ?? []);
+        return;
     }
+    if (msg.type === 'now_playing' || msg.type === 'next' || msg.type === 'queue') {
+        if (msg.room !== undefined && msg.room !== djRoom) return;
+        lastState[msg.type] = msg;
+        io.emit(msg.type, msg);
+    }
+};
+
+// ゲスト ID は接続ごとに変わる socket.id ではなく、クライアントが handshake の auth で送る固定 ID を使う
+// （再接続・再読み込みで回数制限や投票の重複判定をすり抜けないように）。無い・不正な値なら socket.id
+const CLIENT_ID_PATTERN = /^[A-Za-z0-9-]{8,64}$/;
+
+const guestId = (socket) => {
+    const id = socket.handshake.auth?.clientId;
+    return typeof id === 'string' && CLIENT_ID_PATTERN.test(id) ? id : socket.id;
 };
 
 export const setupSocket = (io) => {
-    startPythonDJ();
+    connectDJ(io);
+
+    // カタログの差分は全員へ（接続ごとにフォルダを読み直さない）
+    onCatalogDelta((delta) => io.emit('catalog_delta', delta));
 
     io.on('connection', (socket) => {
-      console.log(`[Connect] ${socket.id}`);
+      const guest = guestId(socket);
+      console.log(`[Connect] ${socket.id} (guest ${guest})`);
   
-      // 曲リスト送信
-      if (fs.existsSync(CONFIG.MUSIC_DIR)) {
-        const files = fs.readdirSync(CONFIG.MUSIC_DIR).filter(file => {
-          return !file.startsWith('.') && CONFIG.ALLOWED_EXTENSIONS.some(ext => file.endsWith(ext));
-        });
-        socket.emit('update_song_list', files);
-      }
+      // 曲カタログ（メモリ上のスナップショット）
+      socket.emit('catalog_snapshot', getSnapshot());
+
+      // 再生状態（最後に受け取ったもの）
+      for (const state of Object.values(lastState)) socket.emit(state.type, state);
   
       // リクエスト受信
       socket.on('request_song', (data) => {
         console.log(`[Request] ${data.title}`);
-        
-        // JSONに保存
-        saveRequestToJSON(data.title);
-
-        // Pythonへ命令
-        if (pythonProcess) {
-            const payload = {
-                title: data.title,
-                start: data.start ?? 0,
-                end: data.end ?? 10000
-            };
-            pythonProcess.stdin.write(JSON.stringify(payload) + "\n");
+
+        if (dj) {
+            // Python DJ へ直接送る（受理・曲名解決の結果は request_result でこの接続に返る）
+            sendCommand({ cmd: 'request', title: data.title, guest, source: 'web' }, socket.id);
         } else {
-            startPythonDJ(); 
+            // DJ 未起動・再接続中はキューに追記（起動後に Python 側が受け付ける。結果はまだ分からない）
+            appendRequest(data.title, { guest });
+            socket.emit('request_result', { ok: true, result: 'pending', title: data.title });
         }
       });
     });
-};
\ No newline at end of file
+};
@@ -2,13 +2,14 @@ import { useEffect, useState } from 'react';
 import { ChakraProvider, Box, Text, Spinner, Center } from '@chakra-ui/react';
 import { io, Socket } from 'socket.io-client';
 import { GuestPage } from './pages/GuestPage';
+import { getClientId } from './hooks/useSocket';
 
 function App() {
   const [socket, setSocket] = useState<Socket | null>(null);
 
   useEffect(() => {
     // サーバーへの接続
-    const newSocket = io(); 
+    const newSocket = io({ auth: { clientId: getClientId() } });
     setSocket(newSocket);
 
     return () => {
@@ -9,13 +9,15 @@ import { Socket } from 'socket.io-client';
 type Props = {
   originalName: string;
   title: string;
+  bpm?: number | null;
+  camelot?: string | null;
   isActive: boolean;
   onSelect: () => void;
   onClose: () => void;
   socket: Socket | null;
 };
 
-export const GuestSongRow = ({ originalName, title, isActive, onSelect, onClose, socket }: Props) => {
+export const GuestSongRow = ({ originalName, title, bpm, camelot, isActive, onSelect, onClose, socket }: Props) => {
   const toast = useToast();
   const [isPlaying, setIsPlaying] = useState(false);
   const [currentTime, setCurrentTime] = useState(0);
@@ -44,17 +46,10 @@ export const GuestSongRow = ({ originalName, title, isActive, onSelect, onClose,
     }
   };
 
+  // 受け付けたか・断られたかは request_result で届く（GuestPage でトースト表示）
   const sendRequest = () => {
     if (!socket) return;
     socket.emit('request_song', { title: originalName });
-    toast({
-      title: "リクエスト送信",
-      description: title,
-      status: "success",
-      duration: 2000,
-      position: "top",
-      icon: <MdSend />
-    });
   };
 
   return (
@@ -70,6 +65,11 @@ export const GuestSongRow = ({ originalName, title, isActive, onSelect, onClose,
         <Text fontSize="md" color={isActive ? "white" : "gray.300"} flex={1} noOfLines={1}>
           {title}
         </Text>
+        {bpm != null && (
+          <Text fontSize="xs" color="gray.500" flexShrink={0}>
+            {Math.round(bpm)} BPM{camelot && camelot !== '00X' ? ` · ${camelot}` : ''}
+          </Text>
+        )}
         {isActive && <Icon as={MdClose} color="gray.500" />}
       </HStack>
 
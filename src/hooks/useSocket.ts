@@ -4,11 +4,29 @@ import { io, Socket } from 'socket.io-client';
 // サーバーと同じポートは使わず、Viteのプロキシ経由で接続するのでパスだけでOK
 const SOCKET_URL = '/'; 
 
+// ゲストを見分ける ID（リクエストの回数制限・投票の鍵）。再接続・再読み込みしても変わらないよう localStorage に置く
+// crypto.randomUUID は HTTPS / localhost でしか使えないので、LAN の http 接続では乱数で作る
+const CLIENT_ID_KEY = 'numa_client_id';
+
+export const getClientId = (): string => {
+  try {
+    let id = localStorage.getItem(CLIENT_ID_KEY);
+    if (!id) {
+      id = crypto.randomUUID?.() ?? Array.from({ length: 4 }, () => Math.random().toString(36).slice(2, 10)).join('-');
+      localStorage.setItem(CLIENT_ID_KEY, id);
+    }
+    return id;
+  } catch {
+    // localStorage が使えない（プライベートモードなど）→ サーバー側で接続 ID を使う
+    return '';
+  }
+};
+
 export const useSocket = () => {
   const [socket, setSocket] = useState<Socket | null>(null);
 
   useEffect(() => {
-    const newSocket = io(SOCKET_URL);
+    const newSocket = io(SOCKET_URL, { auth: { clientId: getClientId() } });
     setSocket(newSocket);
 
     return () => {
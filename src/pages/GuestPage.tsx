@@ -1,7 +1,7 @@
 import { useEffect, useState, useMemo } from 'react';
 import { 
   Box, Container, VStack, HStack, Text, Spinner, Icon, 
-  Button, Flex, Badge 
+  Button, Flex, Badge, useToast 
 } from '@chakra-ui/react';
 import { Socket } from 'socket.io-client';
 import { MdPlayArrow, MdExpandMore, MdPerson, MdChevronLeft, MdChevronRight } from 'react-icons/md';
@@ -10,16 +10,26 @@ import { TutorialModal } from '../components/guest/TutorialModal';
 // 分割した部品をインポート
 import { GuestHeader, FILTER_TABS } from '../components/guest/GuestHeader';
 import { GuestSongRow } from '../components/guest/GuestSongRow';
+import type { CatalogDelta, CatalogEntry, CatalogSnapshot, RequestResult } from '../types';
 
 type Props = { socket: Socket | null };
 
-type SongInfo = { originalName: string; title: string; };
+type SongInfo = { originalName: string; title: string; bpm: number | null; camelot: string | null; };
 type GroupedSongs = { [artist: string]: SongInfo[]; };
 
 const ITEMS_PER_PAGE = 30;
 
+// 断られた理由（DJ の error）→ ゲスト向けの説明
+const REJECT_REASONS: { [error: string]: string } = {
+  rate_limited: "リクエストが続いています。少し待ってからもう一度どうぞ",
+  already_voted: "この曲にはもう投票しています",
+  not_found: "曲が見つかりませんでした",
+};
+
+const songName = (fileName: string) => fileName.replace(/\.[^/.]+$/, '');
+
 export const GuestPage = ({ socket }: Props) => {
-  const [songs, setSongs] = useState<string[]>([]);
+  const [catalog, setCatalog] = useState<Map<string, CatalogEntry>>(new Map());
   const [searchTerm, setSearchTerm] = useState("");
   const [selectedFilter, setSelectedFilter] = useState('ALL');
   const [currentPage, setCurrentPage] = useState(1);
@@ -27,18 +37,61 @@ export const GuestPage = ({ socket }: Props) => {
   // UI状態
   const [expandedArtist, setExpandedArtist] = useState<string | null>(null);
   const [activeSong, setActiveSong] = useState<string | null>(null);
+  const toast = useToast();
 
-  // ソケット受信
+  // リクエストの結果（受け付け・投票・保留・お断り）を表示する
+  useEffect(() => {
+    if (!socket) return;
+    const onResult = (res: RequestResult) => {
+      const name = songName(res.track ?? res.title ?? "");
+      if (!res.ok) {
+        toast({
+          title: "リクエストできません",
+          description: `${REJECT_REASONS[res.error ?? ""] ?? `エラー (${res.error})`}: ${name}`,
+          status: "warning", duration: 4000, position: "top", isClosable: true
+        });
+      } else if (res.result === 'voted') {
+        toast({ title: "投票しました", description: `${name}（${res.votes} 票）`,
+                status: "success", duration: 2500, position: "top" });
+      } else if (res.result === 'pending') {
+        toast({ title: "リクエスト送信", description: `${name}（DJ の準備ができ次第受け付けます）`,
+                status: "info", duration: 3000, position: "top" });
+      } else {
+        toast({ title: "リクエスト受付", description: name, status: "success", duration: 2000, position: "top" });
+      }
+    };
+    socket.on('request_result', onResult);
+    return () => {
+      socket.off('request_result', onResult);
+    };
+  }, [socket, toast]);
+
+  // ソケット受信（接続時にスナップショット、以後は差分だけ）
   useEffect(() => {
     if (!socket) return;
-    socket.on('update_song_list', setSongs);
-    return () => { socket.off('update_song_list'); };
+    const onSnapshot = (snap: CatalogSnapshot) => {
+      setCatalog(new Map(snap.songs.map(entry => [entry[0], entry])));
+    };
+    const onDelta = (delta: CatalogDelta) => {
+      setCatalog(prev => {
+        const next = new Map(prev);
+        delta.removed.forEach(name => next.delete(name));
+        delta.added.forEach(entry => next.set(entry[0], entry));
+        return next;
+      });
+    };
+    socket.on('catalog_snapshot', onSnapshot);
+    socket.on('catalog_delta', onDelta);
+    return () => {
+      socket.off('catalog_snapshot', onSnapshot);
+      socket.off('catalog_delta', onDelta);
+    };
   }, [socket]);
 
   // データ変換: アーティスト別にグループ化
   const { groupedSongs, artistNames } = useMemo(() => {
     const groups: GroupedSongs = {};
-    songs.forEach(fileName => {
+    catalog.forEach(([fileName, bpm, camelot]) => {
       const cleanName = fileName.replace(/^\d+[\s_]+/, '').replace(/\.[^/.]+$/, '');
       const parts = cleanName.split(' - ');
       
@@ -47,13 +100,13 @@ export const GuestPage = ({ socket }: Props) => {
       const title = parts.length >= 2 ? parts[1].trim() : cleanName;
 
       if (!groups[artist]) groups[artist] = [];
-      groups[artist].push({ originalName: fileName, title });
+      groups[artist].push({ originalName: fileName, title, bpm, camelot });
     });
     
     // あいうえお順ソート
     const sortedArtists = Object.keys(groups).sort((a, b) => a.localeCompare(b, 'ja'));
     return { groupedSongs: groups, artistNames: sortedArtists };
-  }, [songs]);
+  }, [catalog]);
 
   // フィルタリング処理
   const filteredArtists = useMemo(() => {
@@ -99,7 +152,7 @@ export const GuestPage = ({ socket }: Props) => {
 
       {/* アーティストリスト */}
       <Container maxW="container.sm" px={0}>
-        {songs.length === 0 ? (
+        {catalog.size === 0 ? (
           <Box py={20} textAlign="center" color="gray.500"><Spinner color="pink.500" mb={4} /><Text>Loading...</Text></Box>
         ) : (
           <VStack spacing={0} align="stretch">
@@ -132,6 +185,8 @@ export const GuestPage = ({ socket }: Props) => {
                           key={song.originalName}
                           originalName={song.originalName}
                           title={song.title}
+                          bpm={song.bpm}
+                          camelot={song.camelot}
                           isActive={activeSong === song.originalName}
                           onSelect={() => setActiveSong(song.originalName)}
                           onClose={() => setActiveSong(null)}
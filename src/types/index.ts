@@ -8,4 +8,32 @@ export interface PlayRequest {
 export interface DeckState {
   isActive: boolean;
   song: string | null;
-}
\ No newline at end of file
+}
+
+// 曲カタログ: [ファイル名, BPM, Camelot, 曲長(秒)]（未解析の曲は null）
+export type CatalogEntry = [title: string, bpm: number | null, camelot: string | null, duration: number | null];
+
+export interface CatalogSnapshot {
+  version: number;
+  songs: CatalogEntry[];
+}
+
+// added は追加・更新、removed は削除された曲のファイル名
+export interface CatalogDelta {
+  version: number;
+  added: CatalogEntry[];
+  removed: string[];
+}
+
+// request_song の結果。pending は DJ 未接続でファイルキューに回した（受け付けは DJ の起動後）
+export type RequestOutcome = 'queued' | 'voted' | 'already_voted' | 'rate_limited' | 'pending';
+
+export interface RequestResult {
+  ok: boolean;
+  title?: string;
+  track?: string;
+  result?: RequestOutcome;
+  votes?: number;
+  error?: string;          // rate_limited / already_voted / not_found / unknown_room など
+  candidates?: string[];
+}